@@ -0,0 +1 @@
+"""Benchmarks against a local mock Kemono server; see benchmarks/run.py."""
@@ -0,0 +1,146 @@
+"""Local stand-in for the parts of the Kemono API the downloader uses.
+
+Serves synthetic creators at /api/v1/{service}/user/{id}/posts (and
+/post/{id}) plus their images under /data/, with optional injected latency
+and 429s. Content is generated on the fly from the post number, so every run
+sees the same bytes.
+
+    python -m benchmarks.mock_server --posts 500 --images 2 --latency-ms 20
+
+Prints "listening on <url>" once it accepts requests.
+"""
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+PAGE_SIZE = 50
+WORDS = ("the quiet rain fell over a city that had forgotten its own name while "
+         "she counted the lanterns one by one and waited for the bell").split()
+POSTS_RE = re.compile(r'^/api/v1/([^/]+)/user/([^/]+)/posts$')
+POST_RE = re.compile(r'^/api/v1/([^/]+)/user/([^/]+)/post/(\d+)$')
+
+class Creator:
+    """A synthetic creator: `posts` chapters of about `content_kb` KB with `images` images each."""
+    def __init__(self, posts=200, content_kb=8, images=1, image_kb=64):
+        self.count = posts
+        self.content_kb = content_kb
+        self.images = images
+        self.image_kb = image_kb
+
+    def post(self, service, user, n, content=True):
+        """Post number n (0 is the oldest); published one hour apart."""
+        published = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(1_600_000_000 + n * 3600))
+        post = {"id": str(n), "user": user, "service": service, "title": f"Chapter {n + 1}",
+                "published": published, "edited": None}
+        if content: post["content"] = self.content(service, user, n)
+        return post
+
+    def content(self, service, user, n):
+        rng = random.Random(n)
+        paragraphs, size = [], 0
+        while size < self.content_kb * 1024:
+            text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(40, 120)))
+            paragraphs.append(f"<p>{text.capitalize()}.</p>")
+            size += len(text) + 7
+        for i in range(self.images):
+            at = rng.randint(0, len(paragraphs))
+            paragraphs.insert(at, f'<p><img src="/data/{service}/{user}/{n}/{i}.png"></p>')
+        return '\n'.join(paragraphs)
+
+    def page(self, service, user, offset, content=True):
+        """Newest first, like the real listing."""
+        newest = self.count - 1 - offset
+        return [self.post(service, user, n, content) for n in range(newest, max(-1, newest - PAGE_SIZE), -1)]
+
+    def image(self, path):
+        # Unique bytes per URL, so the content-addressed image cache can't dedupe them
+        seed = path.encode()
+        return b'\x89PNG\r\n\x1a\n' + (seed * (self.image_kb * 1024 // len(seed) + 1))[:self.image_kb * 1024]
+
+class MockKemono(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, creator, port=0, latency_ms=0, rate_429=0.0, retry_after=1):
+        super().__init__(('127.0.0.1', port), MockHandler)
+        self.creator = creator
+        self.latency = latency_ms / 1000
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.requests = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like the real server
+
+    def log_message(self, *args): pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock: server.requests += 1
+        if server.latency: time.sleep(server.latency)
+        if server.rate_429 and random.random() < server.rate_429:
+            with server.lock: server.throttled += 1
+            return self.reply(429, b'', 'text/plain', {'Retry-After': str(server.retry_after)})
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        creator = server.creator
+        if (m := POSTS_RE.match(url.path)):
+            offset = int(query.get('o', ['0'])[0])
+            # Like Kemono, bodies are only included for a search query
+            page = creator.page(*m.groups(), offset, content='q' in query)
+            return self.reply(200, json.dumps(page).encode(), 'application/json')
+        if (m := POST_RE.match(url.path)):
+            service, user, n = m.groups()
+            if int(n) >= creator.count: return self.reply(404, b'', 'text/plain')
+            return self.reply(200, json.dumps({"post": creator.post(service, user, int(n))}).encode(), 'application/json')
+        if url.path.startswith('/data/'):
+            return self.reply(200, creator.image(url.path), 'image/png')
+        self.reply(404, b'', 'text/plain')
+
+    def reply(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items(): self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def add_arguments(parser):
+    parser.add_argument("--posts", type=int, default=200, help="chapters per creator")
+    parser.add_argument("--content-kb", type=int, default=8, help="approximate chapter size")
+    parser.add_argument("--images", type=int, default=1, help="images per chapter")
+    parser.add_argument("--image-kb", type=int, default=64, help="size of each image")
+    parser.add_argument("--latency-ms", type=float, default=0, help="delay added to every response")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After sent with each 429")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a synthetic Kemono creator on localhost.")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    creator = Creator(args.posts, args.content_kb, args.images, args.image_kb)
+    server = MockKemono(creator, args.port, args.latency_ms, args.rate_429, args.retry_after)
+    print(f"listening on {server.url}", flush=True)
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    finally: print(f"{server.requests} requests, {server.throttled} throttled", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
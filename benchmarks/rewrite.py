@@ -0,0 +1,66 @@
+"""Chapter rewrite benchmark: turning post bodies into XHTML for the book.
+
+Times three ways of rewriting the same synthetic chapters (img srcs pointed
+at the book's copies, cleaned up and normalized to XHTML):
+
+    replace   the old two-pass way: str.replace() over the whole body per image, then to_xhtml()
+    serial    rendered_chapters() with one worker: a single parse per chapter
+    parallel  rendered_chapters() with --workers processes
+
+No network is involved. Large chapters with many images are where the
+per-image passes hurt:
+
+    python -m benchmarks.rewrite --chapters 200 --content-kb 256 --images 40
+"""
+import sys
+import time
+import html
+import argparse
+
+import kemono.core as core
+from kemono.core import ChapterRecord, BodySpill, IMG_SRC_RE, chapter_images, rendered_chapters, to_xhtml
+from .mock_server import Creator
+
+def legacy_rewrite(chapter, body, src_map):
+    for src in set(IMG_SRC_RE.findall(body)):
+        if (href := src_map.get(src)): body = body.replace(src, href)
+    return to_xhtml(f'<h1>{html.escape(chapter.title)}</h1>{body}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark rewriting chapter bodies into XHTML.")
+    parser.add_argument("--chapters", type=int, default=200)
+    parser.add_argument("--content-kb", type=int, default=256, help="approximate chapter size")
+    parser.add_argument("--images", type=int, default=40, help="images per chapter")
+    parser.add_argument("--workers", type=int, default=None, help="processes for the parallel run (default: REWRITE_WORKERS)")
+    args = parser.parse_args(argv)
+
+    core.REWRITE_MIN_CHAPTERS = 0 # Always use the pool for the parallel run
+    workers = args.workers or max(2, core.REWRITE_WORKERS)
+
+    creator = Creator(args.chapters, args.content_kb, args.images)
+    with BodySpill() as spill:
+        chapters = []
+        for n in range(args.chapters):
+            post = creator.post('bench', '1', n)
+            chapters.append(ChapterRecord.from_post(post)._replace(body=spill.put(post['content'])))
+        total_mb = sum(ref[2] for _, _, _, ref in chapters) / 2**20
+        src_map = {src: f"images/img_{i:06}.png" for i, src in
+                   enumerate(sorted({src for ch in chapters for src in chapter_images(ch)}))}
+        print(f"{args.chapters} chapters, {total_mb:.1f} MB, {len(src_map)} images")
+
+        runs = {
+            'replace': lambda: [legacy_rewrite(ch, BodySpill.read(ch.body), src_map) for ch in chapters],
+            'serial': lambda: list(rendered_chapters(chapters, src_map, workers=1)),
+            'parallel': lambda: list(rendered_chapters(chapters, src_map, workers=workers)),
+        }
+        for name, run in runs.items():
+            start = time.perf_counter()
+            pages = run()
+            elapsed = time.perf_counter() - start
+            assert len(pages) == len(chapters)
+            label = f"{name} ({workers} workers)" if name == 'parallel' else name
+            print(f"{label:<22}{elapsed:>8.2f}s{total_mb / elapsed:>9.1f} MB/s{len(chapters) / elapsed:>9.1f} chapters/s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""Download benchmark: the real client against benchmarks.mock_server.
+
+Runs four phases in a scratch directory (so posts.db, image_cache/ and
+the state files of the real install are never touched):
+
+    pages   load_all() over the whole (metadata-only) listing, cold post cache
+    bodies  load_posts() of every chapter, cold
+    images  fetch_images() for every image, cold image cache
+    build   download() of every chapter into an EPUB, warm image cache
+
+and reports pages/sec, listing traffic, bodies/sec, images/sec, build time
+and the peak traced memory of each phase. Results are saved as JSON under
+benchmarks/results/ so a later run can be compared against them:
+
+    python -m benchmarks.run --posts 1000 --images 2 --repeat 3
+    python -m benchmarks.run --posts 1000 --images 2 --compare benchmarks/results/<before>.json
+
+Rate limits are lifted unless --rps / --file-rps are given, so the numbers
+show the client's own overhead rather than its courtesy pacing. Memory is
+measured with tracemalloc, which slows every phase down by the same factor;
+compare runs with each other, not with real-world timings.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+
+from .mock_server import add_arguments
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO, 'benchmarks', 'results')
+UNLIMITED_RATE = 1e6
+# Metric -> True if higher is better
+METRICS = {
+    'pages_per_sec': True, 'bodies_per_sec': True, 'images_per_sec': True, 'image_mb_per_sec': True,
+    'pages_seconds': False, 'bodies_seconds': False, 'images_seconds': False, 'build_seconds': False,
+    'pages_mb': False, 'pages_peak_mb': False, 'bodies_peak_mb': False, 'images_peak_mb': False, 'build_peak_mb': False,
+}
+
+def start_server(args):
+    """Starts the mock server in its own process, so it doesn't count towards our memory."""
+    cmd = [sys.executable, '-m', 'benchmarks.mock_server', '--posts', str(args.posts),
+           '--content-kb', str(args.content_kb), '--images', str(args.images), '--image-kb', str(args.image_kb),
+           '--latency-ms', str(args.latency_ms), '--rate-429', str(args.rate_429), '--retry-after', str(args.retry_after)]
+    proc = subprocess.Popen(cmd, cwd=REPO, stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline()
+    if not line.startswith('listening on '):
+        proc.kill()
+        raise RuntimeError("mock server failed to start")
+    return proc, line.split()[-1]
+
+def measure(fn):
+    """(result, seconds, peak traced MB) of fn()."""
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    return result, elapsed, tracemalloc.get_traced_memory()[1] / 2**20
+
+def run_once(args, base_url):
+    from kemono.core import KemonoClient, ChapterRecord, BodySpill, chapter_images, BASE_URL
+
+    client = KemonoClient(data_dir=os.getcwd())
+    client.scheduler.api_rate = args.rps or UNLIMITED_RATE
+    client.scheduler.file_rate = args.file_rps or UNLIMITED_RATE
+    api_url = f"{base_url}/api/v1/bench/user/1"
+
+    pages, pages_s, pages_mb = measure(lambda: [data for _, data in client.load_all(api_url, 0)])
+    listing_bytes = client.metrics.snapshot()['counters'].get('http.api.bytes', 0)
+    records = [ChapterRecord.from_post(p) for page in pages for p in page]
+
+    with BodySpill() as spill:
+        posts, bodies_s, bodies_mb = measure(lambda: client.load_posts(api_url, records, spill))
+
+        urls = {u if u.startswith('http') else BASE_URL + u for p in posts for u in chapter_images(p)}
+        (fetched, failures), images_s, images_mb = measure(lambda: client.fetch_images(urls))
+        image_bytes = sum(os.path.getsize(client.image_cache.blob_path(d)) for d, _ in fetched.values())
+
+        profile = {'title': 'Benchmark', 'author': 'Mock', 'directory': os.path.join(os.getcwd(), 'out')}
+        ([path], _), build_s, build_mb = measure(lambda: client.download(list(posts), profile))
+
+    return {
+        'pages': len(pages), 'posts': len(posts), 'images': len(fetched), 'image_failures': len(failures),
+        'epub_mb': round(os.path.getsize(path) / 2**20, 2),
+        'pages_seconds': round(pages_s, 3), 'pages_per_sec': round(len(pages) / pages_s, 2),
+        'pages_mb': round(listing_bytes / 2**20, 3),
+        'bodies_seconds': round(bodies_s, 3), 'bodies_per_sec': round(len(posts) / max(bodies_s, 1e-9), 2),
+        'images_seconds': round(images_s, 3), 'images_per_sec': round(len(fetched) / max(images_s, 1e-9), 2),
+        'image_mb_per_sec': round(image_bytes / 2**20 / max(images_s, 1e-9), 2),
+        'build_seconds': round(build_s, 3),
+        'pages_peak_mb': round(pages_mb, 2), 'bodies_peak_mb': round(bodies_mb, 2),
+        'images_peak_mb': round(images_mb, 2), 'build_peak_mb': round(build_mb, 2),
+    }
+
+def summarize(runs):
+    return {key: round(statistics.median(run[key] for run in runs), 3) for key in runs[0]}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError: return None
+
+def compare(old, new):
+    print(f"\n{'metric':<18}{'before':>12}{'after':>12}{'change':>10}")
+    for key, higher_is_better in METRICS.items():
+        if key not in old or key not in new: continue
+        before, after = old[key], new[key]
+        change = (after - before) / before * 100 if before else 0.0
+        better = change > 0 if higher_is_better else change < 0
+        mark = '' if abs(change) < 5 else (' better' if better else ' WORSE')
+        print(f"{key:<18}{before:>12}{after:>12}{change:>+9.1f}%{mark}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the downloader against a local mock server.")
+    add_arguments(parser)
+    parser.add_argument("--rps", type=float, help="API requests per second (default: unlimited)")
+    parser.add_argument("--file-rps", type=float, help="image requests per second (default: unlimited)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs to take the median of")
+    parser.add_argument("--label", help="stored with the results")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<time>.json)")
+    parser.add_argument("--compare", metavar="RESULTS", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    proc, base_url = start_server(args)
+    # Relative image paths resolve against the mock server
+    os.environ['KEMONO_BASE_URL'] = base_url
+    sys.path.insert(0, REPO)
+    home = os.getcwd()
+    runs = []
+    tracemalloc.start()
+    try:
+        for n in range(args.repeat):
+            workdir = tempfile.mkdtemp(prefix='kemono-bench-')
+            os.chdir(workdir)
+            try: runs.append(run_once(args, base_url))
+            finally:
+                os.chdir(home)
+                shutil.rmtree(workdir, ignore_errors=True)
+            print(f"run {n + 1}/{args.repeat}: " + ', '.join(f"{k}={v}" for k, v in runs[-1].items()))
+    finally:
+        tracemalloc.stop()
+        proc.terminate()
+        proc.wait()
+
+    config = {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'label')}
+    result = {
+        'label': args.label, 'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(), 'platform': platform.platform(),
+        'config': config, 'summary': summarize(runs), 'runs': runs,
+    }
+    if not (path := args.output):
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    with open(path, 'w') as f: json.dump(result, f, indent=2)
+    print(f"\nSaved {path}")
+
+    if args.compare:
+        with open(args.compare) as f: old = json.load(f)
+        if old.get('config') != config: print("Note: the runs being compared used different settings")
+        compare(old['summary'], result['summary'])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
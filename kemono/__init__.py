@@ -0,0 +1,4 @@
+"""Core, caches, EPUB writer and GUI of the Kemono Webnovel Downloader.
+
+kemono.gui is the only module that imports PyQt6.
+"""
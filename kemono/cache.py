@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+
+POST_CACHE_FILE = "posts.db"
+IMAGE_CACHE_DIR = "image_cache"
+IMAGE_CACHE_MAX_MB = 1024   # Least recently used images are evicted past this size
+# Condition on posts rows: at or after the oldest post of their creator's listed run (never true without one)
+LISTED = ("(COALESCE(published, ''), post_id) >= (SELECT published, post_id FROM listed "
+          "WHERE listed.service = posts.service AND listed.user_id = posts.user_id)")
+
+# --- Post Cache ---
+class PostCache:
+    """SQLite store of every post seen, keyed by (service, user id, post id).
+
+    Listings only carry metadata, so a row holds a body (its 'content' key)
+    only once the post itself was fetched; bodies() yields just those.
+
+    Posts also get cached out of order (pages found by seeking, single posts
+    whose body was fetched), so a creator's 'listed' row marks the oldest post
+    of the unbroken run of listing pages from the newest one. count() and
+    listing() only cover that run, which is what paging resumes after. A
+    single connection is shared between worker threads behind a lock.
+    """
+    def __init__(self, path=POST_CACHE_FILE):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS posts (
+                service TEXT NOT NULL, user_id TEXT NOT NULL, post_id TEXT NOT NULL,
+                published TEXT, edited TEXT, data TEXT NOT NULL,
+                PRIMARY KEY (service, user_id, post_id))""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS posts_by_date ON posts (service, user_id, published)")
+            # Caches filled by older versions, whose listing query (q=<p>) only listed posts with
+            # text, have no listed rows yet: they are listed afresh, and their bodies still count
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS listed (
+                service TEXT NOT NULL, user_id TEXT NOT NULL, published TEXT NOT NULL, post_id TEXT NOT NULL,
+                PRIMARY KEY (service, user_id))""")
+
+    @staticmethod
+    def creator_key(api_url):
+        """'.../api/v1/{service}/user/{id}[/posts]' -> (service, id)"""
+        parts = api_url.rstrip('/').removesuffix('/posts').split('/')
+        return parts[-3], parts[-1]
+
+    def store(self, api_url, posts, offset=None):
+        """Upserts posts; returns how many were new or edited since they were last stored.
+
+        A metadata-only post never replaces a cached body unless it was edited
+        since, and a body fills in the metadata-only row of the same edit.
+        `offset` is given for a listing page: one that starts inside or right
+        after the listed run extends it.
+        """
+        service, user_id = self.creator_key(api_url)
+        changed = 0
+        with self.lock, self.conn:
+            for post in posts:
+                pid = str(post.get('id'))
+                row = self.conn.execute("SELECT edited, json_type(data, '$.content') IS NOT NULL FROM posts "
+                                        "WHERE service=? AND user_id=? AND post_id=?", (service, user_id, pid)).fetchone()
+                if row is not None and row[0] == post.get('edited'):
+                    if row[1] or 'content' not in post: continue
+                else: changed += 1
+                self.conn.execute("INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?)",
+                                  (service, user_id, pid, post.get('published'), post.get('edited'), json.dumps(post)))
+            if posts and offset is not None and offset <= self.listed_count(service, user_id):
+                oldest = min((post.get('published') or '', str(post.get('id'))) for post in posts)
+                self.conn.execute("""INSERT INTO listed VALUES (?, ?, ?, ?) ON CONFLICT (service, user_id)
+                    DO UPDATE SET published=excluded.published, post_id=excluded.post_id
+                    WHERE (excluded.published, excluded.post_id) < (listed.published, listed.post_id)""",
+                    (service, user_id, *oldest))
+        return changed
+
+    def listed_count(self, service, user_id):
+        # Callers hold the lock
+        return self.conn.execute(f"SELECT COUNT(*) FROM posts WHERE service=? AND user_id=? AND {LISTED}",
+                                 (service, user_id)).fetchone()[0]
+
+    def count(self, api_url):
+        """Number of posts in the listed run (0 until a first page was stored)."""
+        with self.lock:
+            return self.listed_count(*self.creator_key(api_url))
+
+    def posts(self, api_url):
+        """All cached posts for a creator, newest first (same order as the API)."""
+        with self.lock:
+            rows = self.conn.execute("SELECT data FROM posts WHERE service=? AND user_id=? "
+                                     "ORDER BY published DESC, post_id DESC", self.creator_key(api_url)).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def listing(self, api_url):
+        """(post id, title, published) of every post in the listed run, newest first, without decoding bodies."""
+        with self.lock:
+            return self.conn.execute("SELECT post_id, COALESCE(json_extract(data, '$.title'), 'No Title'), "
+                                     f"COALESCE(published, '') FROM posts WHERE service=? AND user_id=? AND {LISTED} "
+                                     "ORDER BY published DESC, post_id DESC", self.creator_key(api_url)).fetchall()
+
+    def bodies(self, api_url, post_ids):
+        """Yields (post id, body) for the subset of post_ids whose body is cached, one row at a time."""
+        service, user_id = self.creator_key(api_url)
+        for pid in post_ids:
+            with self.lock:
+                row = self.conn.execute("SELECT json_extract(data, '$.content') FROM posts "
+                                        "WHERE service=? AND user_id=? AND post_id=? "
+                                        "AND json_type(data, '$.content') IS NOT NULL",
+                                        (service, user_id, str(pid))).fetchone()
+            if row: yield str(pid), row[0] or ''
+
+# --- Body Spill ---
+class BodySpill:
+    """Temp file the chapter bodies of one build are spilled to.
+
+    put() appends a body and returns a (path, offset, length) reference,
+    which is all a ChapterRecord keeps; read() loads one body back, also from
+    a worker process. The file is deleted on close().
+    """
+    def __init__(self, directory=None):
+        fd, self.path = tempfile.mkstemp(prefix='kemono-', suffix='.bodies', dir=directory)
+        self.file = open(fd, 'wb', buffering=0) # Unbuffered, so read() sees every put()
+        self.lock = threading.Lock()
+
+    def put(self, text):
+        data = (text or '').encode('utf-8')
+        with self.lock:
+            offset = self.file.tell()
+            self.file.write(data)
+        return self.path, offset, len(data)
+
+    @staticmethod
+    def read(ref):
+        if not ref: return ''
+        path, offset, length = ref
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length).decode('utf-8')
+
+    def close(self):
+        self.file.close()
+        try: os.remove(self.path)
+        except OSError: pass # Still open in a cancelled volume worker (Windows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# --- Image Cache ---
+class ImageCache:
+    """Content-addressed image store shared by every profile and run.
+
+    Blobs live under <dir>/<digest[:2]>/<digest> (SHA-256 of the bytes) and an
+    index maps each URL to its digest, so identical images fetched from
+    different URLs are stored once. Derived versions of a blob (e.g. an
+    optimized re-encode) are blobs too, found through variant(). Once the
+    total size passes max_bytes the least recently used blobs are evicted;
+    anything used within the last hour is kept, so a running build never
+    loses images it has just resolved.
+    """
+    def __init__(self, directory=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY, size INTEGER NOT NULL, content_type TEXT, last_used REAL NOT NULL)""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS blobs_by_use ON blobs (last_used)")
+            # A variant equal to its digest means the derived version wasn't worth keeping
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS variants (
+                digest TEXT NOT NULL, settings TEXT NOT NULL, variant TEXT NOT NULL, PRIMARY KEY (digest, settings))""")
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def lookup(self, url):
+        """Returns (digest, content_type) for a cached URL and marks it as recently used, else None."""
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT b.digest, b.content_type FROM urls u JOIN blobs b ON b.digest = u.digest "
+                                    "WHERE u.url=?", (url,)).fetchone()
+            if row is None or not os.path.exists(self.blob_path(row[0])): return None
+            self.conn.execute("UPDATE blobs SET last_used=? WHERE digest=?", (time.time(), row[0]))
+            return row
+
+    def put(self, content, content_type):
+        """Writes a blob (unless it exists already) and records it; returns its digest."""
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f: f.write(content)
+            os.replace(tmp, path)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)",
+                              (digest, len(content), content_type, time.time()))
+        return digest
+
+    def store(self, url, content, content_type):
+        """Adds an image and returns its digest."""
+        digest = self.put(content, content_type)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO urls VALUES (?, ?)", (url, digest))
+        self.evict()
+        return digest
+
+    def variant(self, digest, settings):
+        """(digest, content type) of blob `digest` derived with `settings`, or None if there is none yet.
+
+        Where the derived version wasn't worth keeping, that is the blob itself.
+        """
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT b.digest, b.content_type FROM variants v JOIN blobs b ON b.digest = v.variant "
+                                    "WHERE v.digest=? AND v.settings=?", (digest, settings)).fetchone()
+            if row is None or not os.path.exists(self.blob_path(row[0])): return None
+            self.conn.execute("UPDATE blobs SET last_used=? WHERE digest=?", (time.time(), row[0]))
+            return row
+
+    def store_variant(self, digest, settings, content, content_type):
+        """Records the `settings` version of blob `digest` (content None: keep the blob itself); returns its digest."""
+        variant = digest if content is None else self.put(content, content_type)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO variants VALUES (?, ?, ?)", (digest, settings, variant))
+        self.evict()
+        return variant
+
+    def read(self, digest):
+        with open(self.blob_path(digest), "rb") as f: return f.read()
+
+    def evict(self):
+        with self.lock, self.conn:
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total <= self.max_bytes: return
+            stale = self.conn.execute("SELECT digest, size FROM blobs WHERE last_used < ? ORDER BY last_used",
+                                      (time.time() - 3600,)).fetchall()
+            for digest, size in stale:
+                if total <= self.max_bytes: break
+                try: os.remove(self.blob_path(digest))
+                except OSError: pass
+                self.conn.execute("DELETE FROM blobs WHERE digest=?", (digest,))
+                self.conn.execute("DELETE FROM urls WHERE digest=?", (digest,))
+                self.conn.execute("DELETE FROM variants WHERE digest=? OR variant=?", (digest, digest))
+                total -= size
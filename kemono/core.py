@@ -0,0 +1,1038 @@
+import os
+import re
+import sys
+import html
+import time
+import logging
+import itertools
+import threading
+import multiprocessing
+from collections import deque, namedtuple
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor, as_completed
+from urllib.parse import urlparse
+
+from .cache import PostCache, ImageCache, BodySpill, IMAGE_CACHE_MAX_MB, POST_CACHE_FILE, IMAGE_CACHE_DIR
+from .net import (Transport, RequestScheduler, SessionExpired, ApiError,
+                  REQUESTS_PER_SECOND, HTTP_POOL_SIZE, HTML_ACCEPT)
+from .epub import EpubWriter, EPUB_STYLE, to_xhtml
+from .images import (optimize, pillow_available, settings_key, FORMATS, OPTIMIZABLE_MEDIA, OPTIMIZE_WORKERS,
+                     IMAGE_MAX_SIZE, IMAGE_QUALITY, IMAGE_FORMAT)
+from .metrics import Metrics
+from .journal import DownloadJournal, JOURNAL_DIR
+from .state import StateStore, STATE_FILE
+
+log = logging.getLogger(__name__)
+
+# --- Constants ---
+# KEMONO_BASE_URL points the client at a mirror or a local mock (see benchmarks/)
+BASE_URL = os.environ.get("KEMONO_BASE_URL", "https://kemono.cr").rstrip("/")
+API_BASE = f"{BASE_URL}/api/v1"
+# State, caches and journals live next to the program (or KEMONO_DATA_DIR), not in the current
+# directory, so a scheduled run started from anywhere finds the same profiles and queue
+APP_DIR = (os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) # Frozen build: next to the executable
+           else os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DATA_DIR = os.environ.get("KEMONO_DATA_DIR") or APP_DIR
+PAGE_SIZE = 50              # Posts per API page
+PAGINATION_WINDOW = 4       # Offset requests kept in flight by "Load All"
+IMG_SRC_RE = re.compile(r'<img[^>]+src="([^"]+)"')
+PARAGRAPH_RE = re.compile(r'<p[\s>/]', re.IGNORECASE) # Chapters are posts with text; the old listing query was q=<p>
+BODY_WORKERS = 4            # Chapter bodies fetched at once (still paced by the API rate limit)
+IMAGE_WORKERS = 8           # Total concurrent image downloads
+IMAGE_WORKERS_PER_HOST = 4  # Cap per host so a single CDN isn't hammered
+VOLUME_WORKERS = min(4, os.cpu_count() or 1) # Processes building separate volumes at once
+REWRITE_WORKERS = min(4, os.cpu_count() or 1) # Processes turning chapter bodies into XHTML for one book
+REWRITE_MIN_CHAPTERS = 64   # Shorter books are rewritten in-process; starting workers would cost more
+CPU_SLOTS = 1               # Builds that may run their CPU-bound stages (writing, image encoding) at once
+VOLUME_KEYS = ('volume_size', 'append', 'last_volume') # Optional per-profile volume settings and state
+FAVORITES_TTL = 300         # Seconds a favorites snapshot is used without asking the server again
+UPDATE_CHECK_WORKERS = 4    # Profiles checked for new chapters at the same time
+UPDATE_CHECK_BUDGET = 100   # Most API requests one check of all profiles may send
+UPDATE_CHECK_MAX_PAGES = 10 # Pages per profile before a count is reported as "at least"
+
+class Cancelled(Exception):
+    pass
+
+class Job:
+    """Progress and cancellation hooks handed to long-running calls.
+
+    Work functions call check() at safe points (raises Cancelled once cancel()
+    was requested) and report(value) to publish progress. A job with a parent
+    is also cancelled whenever the parent is.
+    """
+    def __init__(self, on_progress=None, parent=None):
+        self.on_progress = on_progress
+        self.parent = parent
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set() or bool(self.parent and self.parent.cancelled)
+
+    def cancel(self):
+        self._cancel.set()
+
+    def check(self):
+        if self.cancelled: raise Cancelled()
+
+    def report(self, value):
+        if self.on_progress: self.on_progress(value)
+
+class ChapterRecord(namedtuple('ChapterRecord', 'id title published body', defaults=(None,))):
+    """What a listing keeps per post; bodies stay in the post cache until a build needs them.
+
+    For a build, load_posts() fills in `body`: a BodySpill reference, read
+    back only while that chapter is written.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_post(cls, post):
+        return cls(str(post.get('id')), post.get('title') or 'No Title', post.get('published') or '')
+
+def sanitize(text):
+    return re.sub(r'[^\w\-]', '_', text or "Untitled")
+
+def volume_name(title, number, size):
+    """(file name, book title) of volume `number`; with no volume size the book is a single growing file."""
+    if not size: return sanitize(title), title
+    return f"{sanitize(title)}_Vol{number:02}", f"{title} Vol. {number}"
+
+def book_name(chapters):
+    """File name of a book of `chapters` (oldest first): its first and last chapter's titles."""
+    t1, t2 = sanitize(chapters[0].title), sanitize(chapters[-1].title)
+    return (t1 if len(chapters) == 1 else f"{t1}-{t2}")[:100]
+
+def image_media(ctype):
+    """(extension, media type) for a downloaded image's Content-Type."""
+    if 'png' in ctype: return 'png', 'image/png'
+    if 'webp' in ctype: return 'webp', 'image/webp'
+    if 'gif' in ctype: return 'gif', 'image/gif'
+    return 'jpg', 'image/jpeg'
+
+# --- Building ---
+def chapter_images(chapter):
+    """img srcs in a ChapterRecord's spilled body."""
+    return IMG_SRC_RE.findall(BodySpill.read(chapter.body))
+
+def render_chapter(chapter, src_map):
+    """XHTML of a ChapterRecord: title heading plus its body, cleaned up with srcs rewritten in a single parse."""
+    return to_xhtml(f'<h1>{html.escape(chapter.title)}</h1>{BodySpill.read(chapter.body)}', src_map)
+
+_worker_src_map = {}
+
+def _init_renderer(src_map):
+    global _worker_src_map
+    _worker_src_map = src_map
+
+def _render_in_worker(chapter):
+    return render_chapter(chapter, _worker_src_map)
+
+def rendered_chapters(chapters, src_map, workers=REWRITE_WORKERS):
+    """Yields render_chapter() of every chapter, in order.
+
+    The parser is pure Python, so threads wouldn't help: with more than one
+    worker and a long enough book, chapters are rendered in worker processes
+    (which read the bodies from the spill themselves), a few ahead of the
+    consumer so finished XHTML doesn't pile up in memory.
+    """
+    if workers <= 1 or len(chapters) < REWRITE_MIN_CHAPTERS:
+        for ch in chapters: yield render_chapter(ch, src_map)
+        return
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_renderer, initargs=(src_map,))
+    try:
+        upcoming = iter(chapters)
+        pending = deque(pool.submit(_render_in_worker, ch) for ch in itertools.islice(upcoming, workers * 4))
+        while pending:
+            xhtml = pending.popleft().result()
+            if (ch := next(upcoming, None)) is not None: pending.append(pool.submit(_render_in_worker, ch))
+            yield xhtml
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def write_book(path, title, author, chapters, images, append=False, job=None, metrics=None, workers=REWRITE_WORKERS):
+    """Writes `chapters` (ChapterRecords with bodies, oldest first) into the EPUB at `path`; returns a metrics snapshot.
+
+    `images` maps each img src as written in the chapters to (blob path,
+    digest, content type) in the image cache. Needs no client state, so
+    volumes can be written in worker processes. With append=True the
+    chapters are added to the end of the existing book at `path`. `workers`
+    processes render the chapters (see rendered_chapters).
+    """
+    job = job or Job()
+    metrics = metrics or Metrics()
+    # Chapters and images are streamed into the file as they are produced,
+    # so memory use doesn't grow with the size of the book
+    with metrics.phase("epub.build"), EpubWriter(path, title, author, append=append) as book:
+        if "style.css" not in book.hrefs: book.add_item("style.css", "text/css", data=EPUB_STYLE)
+
+        # Copy images from the cache into the book, named by content digest so
+        # repeat builds (and appends) reuse the same entries. The parser sees
+        # srcs with entities decoded, so that is how they are looked up.
+        src_map = {}
+        for src, (blob, digest, ctype) in images.items():
+            job.check()
+            ext, mime = image_media(ctype)
+            href = f"images/img_{digest[:16]}.{ext}"
+            if href not in book.hrefs:
+                book.add_item(href, mime, source=blob)
+                metrics.add("epub.images")
+            src_map[html.unescape(src)] = href
+
+        with closing(rendered_chapters(chapters, src_map, workers)) as pages:
+            for idx, ch in enumerate(chapters):
+                job.check()
+                job.report(("Building chapters...", idx, len(chapters)))
+                with metrics.phase("html.rewrite"): xhtml = next(pages)
+                book.add_chapter(f"{sanitize(ch.title)}.xhtml", ch.title, xhtml)
+                metrics.add("epub.chapters")
+
+        job.report(("Writing EPUB...", 0, 0))
+    metrics.add("epub.books")
+    metrics.add("epub.bytes", os.path.getsize(path))
+    return metrics.snapshot()
+
+# --- Pagination ---
+class Paginator:
+    """Keeps `window` page requests in flight and yields (offset, posts) in offset order.
+
+    Iteration stops cleanly at the first empty (or short) page; requests still
+    in flight past that point are discarded. A failed page request raises
+    instead of being mistaken for the end of the listing.
+    """
+    def __init__(self, fetch, start=0, window=PAGINATION_WINDOW):
+        self.fetch = fetch
+        self.start = start
+        self.window = max(1, window)
+
+    def __iter__(self):
+        pool = ThreadPoolExecutor(max_workers=self.window)
+        pending = deque()
+        next_offset = self.start
+        try:
+            for _ in range(self.window):
+                pending.append((next_offset, pool.submit(self.fetch, next_offset)))
+                next_offset += PAGE_SIZE
+            while pending:
+                offset, future = pending.popleft()
+                data = future.result()
+                if not data: return
+                yield offset, data
+                if len(data) < PAGE_SIZE: return
+                pending.append((next_offset, pool.submit(self.fetch, next_offset)))
+                next_offset += PAGE_SIZE
+        finally:
+            for _, future in pending: future.cancel()
+            pool.shutdown(wait=False)
+
+# --- Client ---
+class KemonoClient:
+    """Everything the downloader does that doesn't need a display.
+
+    Owns the state store (defaults, login and profiles; see StateStore), the
+    HTTP transport, the post and image caches, EPUB builds and the metrics
+    they record. The GUI and the command line are both thin layers over it.
+    Methods that take `job` are safe to call from worker threads. All of
+    its files are kept under `data_dir`.
+    """
+    def __init__(self, data_dir=DATA_DIR):
+        os.makedirs(data_dir, exist_ok=True)
+        self.data_dir = data_dir
+        self.journal_dir = os.path.join(data_dir, JOURNAL_DIR)
+        self.default_directory = os.getcwd()
+        self.pagination_window = PAGINATION_WINDOW
+        self.requests_per_second = REQUESTS_PER_SECOND
+        self.image_cache_mb = IMAGE_CACHE_MAX_MB
+        self.http_pool_size = HTTP_POOL_SIZE
+        self.http2 = False
+        self.optimize_images = False
+        self.image_max_size = IMAGE_MAX_SIZE
+        self.image_quality = IMAGE_QUALITY
+        self.image_format = IMAGE_FORMAT
+        self.state = StateStore(os.path.join(data_dir, STATE_FILE))
+        self.load_defaults()
+
+        self.metrics = Metrics()
+        self.transport = Transport(pool_size=self.http_pool_size, http2=self.http2)
+        self.scheduler = RequestScheduler(self.transport, api_rate=self.requests_per_second, metrics=self.metrics)
+        self.post_cache = PostCache(os.path.join(data_dir, POST_CACHE_FILE))
+        self.image_cache = ImageCache(os.path.join(data_dir, IMAGE_CACHE_DIR),
+                                      max_bytes=self.image_cache_mb * 1024 * 1024)
+
+        self.logged_in = False
+        if loaded_cookies := self.load_session():
+            self.transport.cookies.update(loaded_cookies)
+            self.logged_in = True
+        self.profiles = {}
+        self.update_checks = {} # url -> (favorites 'updated', last_fetched, (count, exact)) of the last check
+        # Builds may run side by side (see DownloadQueue): they share the profiles and the CPU
+        self.profiles_lock = threading.RLock()
+        self.cpu_slots = threading.Semaphore(CPU_SLOTS)
+
+    # --- State ---
+
+    def load_defaults(self):
+        defaults = self.state.section('defaults')
+        try:
+            self.default_directory = defaults.get('directory', os.getcwd())
+            self.pagination_window = int(defaults.get('pagination_window', PAGINATION_WINDOW))
+            self.requests_per_second = float(defaults.get('requests_per_second', REQUESTS_PER_SECOND))
+            self.image_cache_mb = int(defaults.get('image_cache_mb', IMAGE_CACHE_MAX_MB))
+            self.http_pool_size = int(defaults.get('http_pool_size', HTTP_POOL_SIZE))
+            self.http2 = bool(defaults.get('http2', False))
+            self.optimize_images = bool(defaults.get('optimize_images', False))
+            self.image_max_size = int(defaults.get('image_max_size', IMAGE_MAX_SIZE))
+            self.image_quality = int(defaults.get('image_quality', IMAGE_QUALITY))
+            fmt = defaults.get('image_format', IMAGE_FORMAT)
+            self.image_format = fmt if fmt in FORMATS else IMAGE_FORMAT
+        except (TypeError, ValueError) as e: log.warning(f"Ignoring the rest of the defaults, one is invalid: {e}")
+
+    def defaults(self):
+        return {'directory': self.default_directory, 'pagination_window': self.pagination_window,
+                'requests_per_second': self.requests_per_second, 'image_cache_mb': self.image_cache_mb,
+                'http_pool_size': self.http_pool_size, 'http2': self.http2,
+                'optimize_images': self.optimize_images, 'image_max_size': self.image_max_size,
+                'image_quality': self.image_quality, 'image_format': self.image_format}
+
+    def save_defaults(self):
+        self.state.put('defaults', self.defaults())
+
+    def save_session(self, cookies):
+        self.state.put('account', {'session': cookies})
+
+    def load_session(self):
+        return self.state.get('account', 'session')
+
+    def clear_session(self):
+        # The favorites snapshot belongs to the account
+        self.state.delete('account')
+        self.logged_in = False
+        self.transport.cookies.clear()
+
+    @property
+    def profile_scope(self):
+        """Which profiles are in use: the local list, or those of the logged-in account's favorites."""
+        return 'account' if self.logged_in else 'local'
+
+    def load_profiles(self, revalidate=True):
+        """Reloads self.profiles; raises SessionExpired if the saved login is no longer valid.
+
+        Logged in, the list is built from the favorites snapshot without a
+        request, then (with `revalidate`) brought up to date by
+        revalidate_favorites(). The GUI shows the snapshot first and
+        revalidates in the background instead.
+        """
+        if not self.logged_in:
+            self.profiles = self.load_local_profiles()
+            return self.profiles
+        snapshot = self.state.get('account', 'favorites') or {}
+        self.profiles = self.profiles_from_favorites(snapshot.get('favorites', []), self.state.profiles('account'))
+        if revalidate and (favorites := self.revalidate_favorites()) is not None: self.apply_favorites(favorites)
+        return self.profiles
+
+    def load_local_profiles(self):
+        profiles = {}
+        for url, p in self.state.profiles('local').items():
+            # Clean out old keys
+            profiles[url] = {
+                "title": p.get('title', 'Unknown'),
+                "author": p.get('author', 'Unknown'),
+                "directory": p.get('directory', self.default_directory),
+                "last_fetched": p.get('last_fetched', "")
+            }
+            profiles[url].update({k: p[k] for k in VOLUME_KEYS if k in p})
+        return profiles
+
+    def profiles_from_favorites(self, favorites, local):
+        """Profiles of the favorited creators; titles, directories etc. set locally (in `local`) win."""
+        profiles = {}
+        for p in favorites:
+            p_url = f"{API_BASE}/{p['service']}/user/{p['id']}"
+            existing = local.get(p_url, {})
+            profiles[p_url] = {
+                "title": existing.get('title', p.get('name', "Unknown")),
+                "author": existing.get('author', p.get('public_id', "Unknown")),
+                "last_fetched": existing.get('last_fetched', ""),
+                "directory": existing.get('directory', self.default_directory),
+                "updated": p.get('updated', "")
+            }
+            profiles[p_url].update({k: existing[k] for k in VOLUME_KEYS if k in existing})
+        return profiles
+
+    def apply_favorites(self, favorites):
+        """Brings self.profiles in line with a new favorites list; returns the URLs added, changed or removed.
+
+        Profiles are updated in place, since running builds hold on to them.
+        Newly listed creators get their saved settings, if they have any.
+        """
+        fresh = self.profiles_from_favorites(favorites, {**self.state.profiles('account'), **self.profiles})
+        changed = set()
+        with self.profiles_lock:
+            for url in [url for url in self.profiles if url not in fresh]:
+                del self.profiles[url]
+                changed.add(url)
+            for url, profile in fresh.items():
+                if self.profiles.get(url) != profile:
+                    self.profiles.setdefault(url, {}).update(profile)
+                    changed.add(url)
+        return changed
+
+    def revalidate_favorites(self, force=False, job=None):
+        """The account's favorites if they differ from the snapshot, else None.
+
+        While the snapshot is younger than FAVORITES_TTL nothing is requested
+        (unless `force`). After that the request is conditional on the
+        snapshot's ETag / Last-Modified, so an unchanged list comes back as
+        an empty 304. Errors other than SessionExpired keep the snapshot.
+        """
+        snapshot = self.state.get('account', 'favorites') or {}
+        if not force and time.time() - snapshot.get('checked', 0) < FAVORITES_TTL: return None
+        headers = {}
+        if snapshot.get('etag'): headers['If-None-Match'] = snapshot['etag']
+        if snapshot.get('last_modified'): headers['If-Modified-Since'] = snapshot['last_modified']
+        try:
+            response = self.scheduler.request('GET', f"{API_BASE}/account/favorites?type=artist", headers=headers, job=job)
+            favorites = snapshot.get('favorites', []) if response.status_code == 304 else response.json()
+            if not isinstance(favorites, list): raise ValueError("not a list")
+        except (ApiError, ValueError) as e:
+            log.warning(f"Could not load favorites: {e}")
+            return None
+        self.metrics.add("favorites.not_modified" if response.status_code == 304 else "favorites.fetched")
+        self.state.put('account', {'favorites': {
+            'favorites': favorites, 'checked': time.time(),
+            'etag': response.headers.get('ETag') or snapshot.get('etag'),
+            'last_modified': response.headers.get('Last-Modified') or snapshot.get('last_modified'),
+        }})
+        return None if 'favorites' in snapshot and favorites == snapshot['favorites'] else favorites
+
+    def save_profile(self, url, *keys):
+        """Stores the given fields (default: all) of self.profiles[url]; the others are left as stored."""
+        profile = self.profiles[url]
+        with self.profiles_lock: fields = {k: profile.get(k) for k in keys or profile}
+        self.state.save_profile(self.profile_scope, url, fields)
+
+    def delete_profile(self, url):
+        with self.profiles_lock: del self.profiles[url]
+        self.state.delete_profile(self.profile_scope, url)
+
+    def find_profile(self, key):
+        """Resolves a profile by API URL, creator link, list number (1-based) or title."""
+        if key in self.profiles: return key
+        if (api_url := self.fix_link(key)) and api_url in self.profiles: return api_url
+        urls = list(self.profiles)
+        if key.isdigit() and 1 <= int(key) <= len(urls): return urls[int(key) - 1]
+        matches = [url for url, p in self.profiles.items() if p.get('title', '').lower() == key.lower()]
+        return matches[0] if len(matches) == 1 else None
+
+    # --- Auth & Favorites ---
+
+    def login(self, username, password):
+        """Logs in and saves the session cookies; raises on failure."""
+        response = self.transport.request('POST', f"{API_BASE}/authentication/login", timeout=30,
+                                          json={"username": username, "password": password})
+        response.raise_for_status()
+        self.save_session(self.transport.cookies.get_dict())
+        self.logged_in = True
+
+    def add_favorite(self, api_url):
+        parts = api_url.split('/')
+        self.scheduler.request('POST', f"{API_BASE}/favorites/creator/{parts[-3]}/{parts[-1]}")
+
+    def remove_favorite(self, api_url):
+        parts = api_url.split('/')
+        self.scheduler.request('DELETE', f"{API_BASE}/favorites/creator/{parts[-3]}/{parts[-1]}")
+
+    def fix_link(self, link):
+        if not link: return None
+        link = link.strip()
+        if "patreon.com" in link:
+            try:
+                r = self.scheduler.request('GET', link, accept=HTML_ACCEPT)
+                m = re.search(r'"creator":\s*{\s*"data":\s*{\s*"id":\s*"(\d+)"', r.text)
+                if m: return f"{API_BASE}/patreon/user/{m.group(1)}"
+            except: pass
+            return None
+        if not link.startswith("http"):
+            link = f"https://{link}" if "kemono" in link else link
+        if "kemono" in link:
+            link = link.replace("kemono.su", "kemono.cr")
+            if "/api/v1/" not in link:
+                parts = link.split('kemono.cr/')[-1].split('/')
+                if len(parts) >= 3 and parts[1] == 'user':
+                    return f"{API_BASE}/{parts[0]}/user/{parts[2]}"
+            else: return link
+        return None
+
+    # --- Networking ---
+
+    def request_json(self, url, params=None, job=None):
+        """Thread-safe GET through the scheduler.
+
+        Returns parsed JSON; raises SessionExpired on 401, TransientError once
+        retries are exhausted and ApiError for anything else that went wrong.
+        """
+        response = self.scheduler.request('GET', url, params=params, job=job)
+        try:
+            return response.json()
+        except ValueError:
+            raise ApiError(f"Invalid JSON from {url}")
+
+    def page_request(self, base_api_url, offset=0):
+        if not base_api_url.endswith('/posts'):
+             fetch_url = base_api_url.rstrip('/') + '/posts'
+        else:
+             fetch_url = base_api_url
+
+        # Metadata only: without a search query the listing leaves out post bodies,
+        # which load_posts() fetches per post for the chapters actually being built.
+        # It also lists every post, not just those with text as q=<p> did, so posts
+        # without text count in listings and ranges and are left out by load_posts().
+        params = {'o': offset}
+        log.info(f"Fetching offset {offset} from {fetch_url}")
+        return fetch_url, params
+
+    def fetch_page(self, base_api_url, offset=0, job=None, store=True):
+        """Fetches a single page (50 items) from the API and, unless `store` is off, records it in the post cache.
+
+        An empty list means the end of the listing; failures raise (see request_json).
+        """
+        data = self.request_json(*self.page_request(base_api_url, offset), job=job) or []
+        self.metrics.add("pages.fetched")
+        if store: self.store_page(base_api_url, offset, data)
+        return data
+
+    def store_page(self, base_api_url, offset, data):
+        """Caches a listing page; returns how many of its posts were new or edited."""
+        changed = self.post_cache.store(base_api_url, data, offset)
+        self.metrics.add("posts.changed", changed)
+        return changed
+
+    def sync_posts(self, base_api_url, since=None, job=None):
+        """Incremental sync against the post cache.
+
+        Pages from offset 0 until a page holds only known, unedited posts (and,
+        when `since` is given, until a page reaches posts published at or before
+        it). Returns the same as cached_listing(). A creator with nothing cached
+        and no `since` only gets its first page fetched. Request failures
+        raise, so a partial sync is never mistaken for a complete one.
+        """
+        job = job or Job()
+        had_cache = self.post_cache.count(base_api_url) > 0
+        offset = 0
+        while True:
+            job.check()
+            with self.metrics.phase("pagination.page"):
+                data = self.fetch_page(base_api_url, offset, job=job, store=False)
+            changed = self.store_page(base_api_url, offset, data)
+            if len(data) < PAGE_SIZE: break
+            reached_since = since is None or min(p.get('published') or '' for p in data) <= since
+            if reached_since and (not had_cache or changed == 0): break
+            offset += PAGE_SIZE
+        return self.cached_listing(base_api_url)
+
+    def cached_listing(self, base_api_url):
+        """(ChapterRecords of listed posts newest first, offset paging should continue after), without any requests."""
+        records = [ChapterRecord(*row) for row in self.post_cache.listing(base_api_url)]
+        # Listed posts are a contiguous run from the newest (see PostCache), so paging resumes
+        # at the page holding the oldest of them (any overlap is de-duplicated by callers)
+        return records, max(0, len(records) // PAGE_SIZE * PAGE_SIZE - PAGE_SIZE)
+
+    def load_all(self, base_api_url, start, job=None):
+        """Yields (offset, posts) for every page from `start` to the end, in offset order."""
+        job = job or Job()
+        # Cancelled once iteration ends, so requests still retrying past the last page give up
+        pager = Job(parent=job)
+        pages = Paginator(lambda offset: self.fetch_page(base_api_url, offset, job=pager, store=False),
+                          start=start, window=self.pagination_window)
+        try:
+            # Only time spent waiting for pages counts, not what the caller does with them
+            waited = time.perf_counter()
+            for offset, data in pages:
+                self.metrics.record("pagination.page", time.perf_counter() - waited)
+                # Stored in offset order, not as they arrive, so each page can extend the listed run
+                self.store_page(base_api_url, offset, data)
+                job.check()
+                yield offset, data
+                waited = time.perf_counter()
+        finally:
+            pager.cancel()
+
+    def fetch_all_posts(self, base_api_url, job=None):
+        """ChapterRecords of the complete post history, newest first: syncs, then pages past the cached range."""
+        _, offset = self.sync_posts(base_api_url, job=job)
+        for _ in self.load_all(base_api_url, offset + PAGE_SIZE, job=job): pass
+        return self.cached_listing(base_api_url)[0]
+
+    def seek_page(self, base_api_url, date, pages=None, job=None):
+        """Offset of the first page holding a post published at or before `date` (ISO string).
+
+        Probes pages 0, 1, 2, 4, 8... until one qualifies, then binary searches
+        the last gap, so a listing of N pages costs about 2*log2(N) requests
+        instead of N. Fetched pages are left in `pages` ({offset: posts}). If
+        every post is newer, the offset just past the listing is returned.
+        """
+        pages = {} if pages is None else pages
+        def reached(page):
+            offset = page * PAGE_SIZE
+            if offset not in pages:
+                self.metrics.add("pagination.seek_probes")
+                pages[offset] = self.fetch_page(base_api_url, offset, job=job)
+            data = pages[offset]
+            return not data or min(p.get('published') or '' for p in data) <= date
+
+        if reached(0): return 0
+        lo, hi = 0, 1
+        while not reached(hi): lo, hi = hi, hi * 2
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if reached(mid): hi = mid
+            else: lo = mid
+        return hi * PAGE_SIZE
+
+    def fetch_range(self, base_api_url, after=None, before=None, job=None):
+        """ChapterRecords published after `after` and at or before `before` (either may be None), newest first.
+
+        Seeks straight to the first page that matters instead of paging from
+        offset 0, then pages forward only until posts at or before `after`
+        show up: O(log pages + wanted pages) requests.
+        """
+        pages = {}
+        start = self.seek_page(base_api_url, before, pages, job=job) if before else 0
+        records = []
+        def take(data):
+            """Keeps the matching posts of a page; True once no later page can match."""
+            records.extend(ChapterRecord.from_post(p) for p in data
+                           if (not after or (p.get('published') or '') > after)
+                           and (not before or (p.get('published') or '') <= before))
+            return len(data) < PAGE_SIZE or bool(after and min(p.get('published') or '' for p in data) <= after)
+
+        offset = start
+        while offset in pages: # Already fetched while seeking
+            if take(pages[offset]): return records
+            offset += PAGE_SIZE
+        for _, data in self.load_all(base_api_url, offset, job=job):
+            if take(data): break
+        return records
+
+    # --- Update Checks ---
+
+    def count_new(self, base_api_url, since, budget, job=None):
+        """(posts published after `since`, whether that count is exact), from the first pages only.
+
+        Each page takes a slot from the `budget` semaphore; once it is empty
+        (or after UPDATE_CHECK_MAX_PAGES) the count so far is returned as inexact.
+        """
+        count = 0
+        for page in range(UPDATE_CHECK_MAX_PAGES):
+            if not budget.acquire(blocking=False): return count, False
+            data = self.fetch_page(base_api_url, page * PAGE_SIZE, job=job)
+            new = sum(1 for p in data if (p.get('published') or '') > since)
+            count += new
+            if new < len(data) or len(data) < PAGE_SIZE: return count, True
+        return count, False
+
+    def check_updates(self, job=None, budget=UPDATE_CHECK_BUDGET):
+        """Counts new posts for every profile; returns ({url: (count, exact)}, {url: error}).
+
+        Creators whose favorites 'updated' time isn't after last_fetched, or
+        hasn't changed since the previous check, are answered without any
+        request. The rest are checked concurrently, sharing the scheduler's
+        rate limits and at most `budget` page requests in total. Each result
+        is also reported as job progress, (url, count, exact), once known.
+        Profiles removed while the check runs are left out of the results.
+        """
+        job = job or Job()
+        results, failures = {}, {}
+        todo = []
+        # Runs on a worker thread while the GUI may change the profiles, so it works from a copy
+        with self.profiles_lock:
+            checked = {url: (p.get('last_fetched', ''), p.get('updated', '')) for url, p in self.profiles.items()}
+        for url, (since, updated) in checked.items():
+            previous = self.update_checks.get(url)
+            if updated and since and updated <= since: results[url] = (0, True)
+            elif updated and previous and previous[:2] == (updated, since) and previous[2][1]: results[url] = previous[2]
+            else:
+                todo.append(url)
+                continue
+            self.update_checks[url] = (updated, since, results[url])
+            job.report((url, *results[url]))
+
+        slots = threading.Semaphore(budget)
+        with ThreadPoolExecutor(max_workers=UPDATE_CHECK_WORKERS) as pool:
+            futures = {pool.submit(self.count_new, url, checked[url][0], slots, job): url for url in todo}
+            try:
+                for future in as_completed(futures):
+                    url = futures[future]
+                    try: results[url] = future.result()
+                    except (Cancelled, SessionExpired): raise
+                    except Exception as e:
+                        failures[url] = str(e)
+                        continue
+                    since, updated = checked[url]
+                    self.update_checks[url] = (updated, since, results[url])
+                    job.report((url, *results[url]))
+            except (Cancelled, SessionExpired):
+                for future in futures: future.cancel()
+                raise
+        with self.profiles_lock:
+            gone = checked.keys() - self.profiles.keys()
+        for url in gone:
+            results.pop(url, None)
+            failures.pop(url, None)
+        return results, failures
+
+    def load_posts(self, base_api_url, records, spill, job=None):
+        """`records` (same order) with their bodies spilled to `spill`, ready for download().
+
+        Bodies already in the post cache are copied over one at a time; the
+        rest are fetched with one request per post, BODY_WORKERS at a time, and
+        cached. Only references stay in memory, so a build doesn't grow with
+        the number of chapters. Listings carry metadata only, so this is the
+        one place chapter text is downloaded, and posts without any (image
+        posts, announcements) are left out here.
+        """
+        job = job or Job()
+        refs = {}
+        text = set() # Ids of posts with a paragraph in their body
+        for pid, body in self.post_cache.bodies(base_api_url, [r.id for r in records]):
+            refs[pid] = spill.put(body)
+            if PARAGRAPH_RE.search(body): text.add(pid)
+        missing = [r.id for r in records if r.id not in refs]
+        self.metrics.add("bodies.cache_hits", len(refs))
+        post_base = base_api_url.rstrip('/').removesuffix('/posts')
+
+        def fetch(pid):
+            data = self.request_json(f"{post_base}/post/{pid}", job=job)
+            post = data.get('post', data) if isinstance(data, dict) else None
+            if not post: raise ApiError(f"Post {pid} not found")
+            self.post_cache.store(base_api_url, [post])
+            return spill.put(post.get('content')), bool(PARAGRAPH_RE.search(post.get('content') or ''))
+
+        if missing:
+            with self.metrics.phase("bodies.fetch"), ThreadPoolExecutor(max_workers=BODY_WORKERS) as pool:
+                futures = {pool.submit(fetch, pid): pid for pid in missing}
+                try:
+                    for done, future in enumerate(as_completed(futures), 1):
+                        pid = futures[future]
+                        refs[pid], has_text = future.result()
+                        if has_text: text.add(pid)
+                        job.report(("Fetching chapters...", done, len(futures)))
+                except BaseException:
+                    for future in futures: future.cancel()
+                    raise
+            self.metrics.add("bodies.fetched", len(missing))
+        if (skipped := len(records) - len(text)): log.info(f"Leaving out {skipped} post(s) without text")
+        return [r._replace(body=refs[r.id]) for r in records if r.id in text]
+
+    def fetch_images(self, urls, job=None):
+        """Resolves images through the image cache, downloading misses through a bounded pool.
+
+        Returns ({url: (digest, content_type)}, {url: error}).
+        """
+        job = job or Job()
+        host_slots = {}
+        slots_lock = threading.Lock()
+
+        def fetch(url):
+            host = urlparse(url).netloc
+            with slots_lock:
+                slot = host_slots.setdefault(host, threading.BoundedSemaphore(IMAGE_WORKERS_PER_HOST))
+            with slot:
+                r = self.scheduler.request('GET', url, timeout=60, job=job)
+                ctype = r.headers.get('Content-Type', '').lower()
+                return self.image_cache.store(url, r.content, ctype), ctype
+
+        results, failures = {}, {}
+        misses = []
+        for url in urls:
+            if (hit := self.image_cache.lookup(url)): results[url] = hit
+            else: misses.append(url)
+        cached = len(results)
+        self.metrics.add("images.cache_hits", cached)
+        self.metrics.add("images.cache_misses", len(misses))
+
+        start = time.monotonic()
+        with self.metrics.phase("images.fetch"), ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as pool:
+            futures = {pool.submit(fetch, url): url for url in misses}
+            try:
+                for done, future in enumerate(as_completed(futures), 1):
+                    url = futures[future]
+                    try: results[url] = future.result()
+                    except Exception as e: failures[url] = str(e)
+                    job.check()
+                    job.report(("Downloading images...", done, len(futures)))
+            except Cancelled:
+                for future in futures: future.cancel()
+                raise
+
+        elapsed = max(time.monotonic() - start, 1e-6)
+        fetched = len(results) - cached
+        self.metrics.add("images.failed", len(failures))
+        log.info(f"Images: {cached} cached, {fetched} fetched in {elapsed:.1f}s ({fetched / elapsed:.1f} img/s), {len(failures)} failed")
+        for url, err in failures.items():
+            log.warning(f"Img dl fail ({url}): {err}")
+        return results, failures
+
+    # --- Building ---
+
+    def build(self, url, records, profile, output=None, job=None, journal=None):
+        """Downloads `records` (ChapterRecords of the profile at `url`) as EPUBs; returns ([paths], image failures).
+
+        The whole pipeline: chapter bodies, images, writing, mark_fetched().
+        If none of the posts has any text, nothing is written. It is
+        checkpointed in a DownloadJournal, which is only removed once
+        everything is done, so after a failure, crash or cancel resume()
+        continues with what is left. `output` overrides the profile's directory.
+        """
+        journal = journal or DownloadJournal.create(url, records, output, directory=self.journal_dir)
+        target = dict(profile, directory=output) if output else profile
+        with BodySpill() as spill:
+            journal.update(stage='bodies')
+            chapters = self.load_posts(url, records, spill, job=job)
+            result = self.download(chapters, target, job=job, journal=journal) if chapters else ([], {})
+        self.mark_fetched(url, profile, records)
+        journal.finish()
+        return result
+
+    def pending_builds(self):
+        """Journals of interrupted builds whose profile still exists, oldest first."""
+        return [journal for journal in DownloadJournal.pending(self.journal_dir) if journal.state['url'] in self.profiles]
+
+    def resume(self, journal, job=None):
+        """Continues a build from pending_builds(); returns what build() does."""
+        url = journal.state['url']
+        records = [ChapterRecord(*r) for r in journal.state['records']]
+        return self.build(url, records, self.profiles[url], journal.state['output'], job=job, journal=journal)
+
+    @contextmanager
+    def cpu_slot(self, job=None):
+        """Held around a build's CPU-bound stages, so builds running side by side take turns at them."""
+        job = job or Job()
+        if not self.cpu_slots.acquire(blocking=False):
+            job.report(("Waiting for another build...", 0, 0))
+            while not self.cpu_slots.acquire(timeout=0.5): job.check()
+        try: yield
+        finally: self.cpu_slots.release()
+
+    def download(self, chapters, profile, job=None, journal=None):
+        """Builds EPUBs of `chapters` (from load_posts(), sorted oldest first in place); returns ([paths], image failures).
+
+        Without volume settings this is one book named after its first and last
+        chapter. With profile['volume_size'] the chapters are split into
+        numbered volumes of that many chapters, and with profile['append'] they
+        first top up the profile's last volume (see build_volumes). Progress
+        goes to `journal` (see build()).
+        """
+        journal = journal or DownloadJournal()
+        chapters.sort(key=lambda x: x.published)
+        if profile.get('volume_size') or profile.get('append'):
+            return self.build_volumes(chapters, profile, job=job, journal=journal)
+        path, failures = self.create_epub(chapters, profile['title'], profile['author'], profile, book_name(chapters),
+                                          job=job, journal=journal)
+        return [path], failures
+
+    def mark_fetched(self, url, profile, records):
+        """Advances the profile's last_fetched to the newest downloaded ChapterRecord and saves it.
+
+        Its last_volume is saved as well, since a build may have moved it.
+        """
+        latest = max(r.published for r in records)
+        if url not in self.profiles: return # Deleted while it was being downloaded
+        with self.profiles_lock:
+            if latest > profile.get('last_fetched', ''): profile['last_fetched'] = latest
+            fields = {k: profile[k] for k in ('last_fetched', 'last_volume') if k in profile}
+        self.state.save_profile(self.profile_scope, url, fields)
+
+    def output_dir(self, profile):
+        out_dir = profile.get('directory', self.default_directory)
+        if not os.path.exists(out_dir): os.makedirs(out_dir)
+        return out_dir
+
+    def prepare_images(self, chapters, job=None):
+        """Stages 1-3 of a build: ({img src: (blob path, digest, content type)}, {url: error})."""
+        # Collect every image up front so each URL is only downloaded once
+        full_urls = {}
+        for ch in chapters:
+            for img_url in chapter_images(ch):
+                full_urls.setdefault(img_url, img_url if img_url.startswith('http') else BASE_URL + img_url)
+
+        # Fetch concurrently into the image cache
+        fetched, failures = self.fetch_images(set(full_urls.values()), job=job)
+        images = {}
+        for src, full_url in full_urls.items():
+            if full_url in fetched:
+                digest, ctype = fetched[full_url]
+                images[src] = (self.image_cache.blob_path(digest), digest, ctype)
+        if self.optimize_images: images = self.recompress_images(images, job=job)
+        return images, failures
+
+    def recompress_images(self, images, job=None):
+        """Stage 3 (defaults 'optimize_images'): `images` with each one downscaled and re-encoded where that made it smaller.
+
+        Every source digest is optimized once per setting, in worker processes.
+        The outcome, including "not smaller", is kept in the image cache, so
+        repeat builds and other books with the same images do no work. Images
+        that fail to decode are used as downloaded (and remembered as such).
+        """
+        if not pillow_available():
+            log.warning("Image optimization needs 'pip install Pillow'; images are used as downloaded")
+            return images
+        job = job or Job()
+        settings = settings_key(self.image_max_size, self.image_format, self.image_quality)
+        sources = {digest: (path, ctype) for path, digest, ctype in images.values()
+                   if image_media(ctype)[1] in OPTIMIZABLE_MEDIA}
+        results = {} # source digest -> (digest, content type) to put in the book
+        for digest in sources:
+            if (hit := self.image_cache.variant(digest, settings)): results[digest] = hit
+        todo = [digest for digest in sources if digest not in results]
+        self.metrics.add("images.optimize_cache_hits", len(results))
+
+        if todo:
+            with self.cpu_slot(job):
+                pool = ProcessPoolExecutor(max_workers=min(OPTIMIZE_WORKERS, len(todo)),
+                                           mp_context=multiprocessing.get_context('spawn'))
+                try:
+                    with self.metrics.phase("images.optimize"):
+                        futures = {pool.submit(optimize, sources[digest][0], self.image_max_size, self.image_format,
+                                               self.image_quality): digest for digest in todo}
+                        for done, future in enumerate(as_completed(futures), 1):
+                            job.check()
+                            job.report(("Optimizing images...", done, len(futures)))
+                            digest = futures[future]
+                            path, ctype = sources[digest]
+                            try: data = future.result()
+                            except BrokenExecutor as e:
+                                log.warning(f"Can't optimize {path}: {e}") # Not the image's fault; try again next build
+                                continue
+                            except Exception as e:
+                                log.warning(f"Can't optimize {path}: {e}")
+                                data = None
+                            if data is None:
+                                self.metrics.add("images.not_smaller")
+                            else:
+                                self.metrics.add("images.optimized")
+                                self.metrics.add("images.bytes_saved", os.path.getsize(path) - len(data))
+                                ctype = FORMATS[self.image_format]
+                            results[digest] = (self.image_cache.store_variant(digest, settings, data, ctype), ctype)
+                finally:
+                    pool.shutdown(wait=False, cancel_futures=True)
+
+        optimized = {}
+        for src, (path, digest, ctype) in images.items():
+            if digest in results:
+                new_digest, new_ctype = results[digest]
+                optimized[src] = (self.image_cache.blob_path(new_digest), new_digest, new_ctype)
+            else: optimized[src] = (path, digest, ctype)
+        return optimized
+
+    def create_epub(self, chapters, title, author, profile, filename, job=None, journal=None):
+        """Builds one book; returns (path, image failures)."""
+        journal = journal or DownloadJournal()
+        full_path = os.path.join(self.output_dir(profile), f"{filename}.epub")
+        journal.update(stage='images')
+        images, failures = self.prepare_images(chapters, job=job)
+        journal.update(stage='writing')
+        with self.cpu_slot(job): write_book(full_path, title, author, chapters, images, job=job, metrics=self.metrics)
+        return full_path, failures
+
+    def build_volumes(self, chapters, profile, job=None, journal=None):
+        """Volume mode of download(); returns ([paths], image failures).
+
+        With profile['append'], chapters first go into the book recorded in
+        profile['last_volume'] (until it holds volume_size chapters), without
+        touching what is already in it. The rest are split into new numbered
+        volumes, which are independent and so are written in parallel worker
+        processes. profile['last_volume'] is moved to the newest volume.
+        Chapters the series already has go into a book of their own (see
+        plan_volumes).
+
+        The plan and the volumes already written are kept in `journal`: a
+        resumed build must not re-plan against a book it already appended to,
+        and skips volumes that are done.
+        """
+        job = job or Job()
+        journal = journal or DownloadJournal()
+        if journal.state.get('plan') is None:
+            journal.update(plan=[[path, title, number, [ch.id for ch in volume], append]
+                                 for path, title, number, volume, append in self.plan_volumes(chapters, profile)])
+        by_id = {ch.id: ch for ch in chapters}
+        plan = [(path, title, number, [by_id[i] for i in ids], append)
+                for path, title, number, ids, append in journal.state['plan']]
+        written = journal.state.setdefault('written', [])
+        todo = [volume for volume in plan if volume[0] not in written]
+
+        journal.update(stage='images')
+        images, failures = self.prepare_images([ch for volume in todo for ch in volume[3]], job=job)
+        def volume_images(volume_chapters):
+            return {src: images[src] for ch in volume_chapters
+                    for src in chapter_images(ch) if src in images}
+
+        # The first volume is written here, with progress; the rest in worker processes.
+        # Spawned rather than forked: forking a process that runs threads can deadlock.
+        # Volumes already run side by side, so each renders its chapters in-process.
+        journal.update(stage='writing')
+        with self.cpu_slot(job):
+            pool = None
+            futures = {}
+            if len(todo) > 1:
+                pool = ProcessPoolExecutor(max_workers=min(VOLUME_WORKERS, len(todo) - 1),
+                                           mp_context=multiprocessing.get_context('spawn'))
+                futures = {pool.submit(write_book, path, title, profile['author'], volume, volume_images(volume), append,
+                                       workers=1): path
+                           for path, title, _, volume, append in todo[1:]}
+            try:
+                if todo:
+                    path, title, _, volume, append = todo[0]
+                    write_book(path, title, profile['author'], volume, volume_images(volume), append=append,
+                               job=job, metrics=self.metrics, workers=1 if futures else REWRITE_WORKERS)
+                    written.append(path)
+                    journal.save()
+                for done, future in enumerate(as_completed(futures), 1):
+                    job.check()
+                    job.report(("Building volumes...", done, len(futures)))
+                    self.metrics.merge(future.result())
+                    written.append(futures[future])
+                    journal.save()
+            finally:
+                if pool: pool.shutdown(wait=False, cancel_futures=True)
+
+        if (series := [volume for volume in plan if volume[2] is not None]):
+            path, title, number, _, _ = series[-1]
+            with self.profiles_lock: profile['last_volume'] = {'path': path, 'title': title, 'number': number}
+        return [volume[0] for volume in plan], failures
+
+    def plan_volumes(self, chapters, profile):
+        """[(path, title, number, chapters, append)] of build_volumes(), from the profile's current state.
+
+        With profile['append'] only chapters published after its last_fetched
+        continue the series; older ones (downloaded again) would repeat what
+        the volumes already hold, so they become a separate book named after
+        its chapters, with number None.
+        """
+        size = int(profile.get('volume_size') or 0)
+        out_dir = self.output_dir(profile)
+        last = profile.get('last_volume') or {}
+        number = last.get('number', 0)
+        plan = [] # (path, title, number, chapters, append)
+        earlier = []
+        if profile.get('append'):
+            since = profile.get('last_fetched', '')
+            earlier = [ch for ch in chapters if ch.published <= since]
+            chapters = [ch for ch in chapters if ch.published > since]
+
+        if profile.get('append') and last.get('path') and chapters:
+            count = EpubWriter.chapter_count(last['path'])
+            if count is None:
+                log.warning(f"Can't append to {last['path']} (missing, unreadable or from another program), starting a new volume")
+            elif (room := size - count if size else len(chapters)) > 0:
+                plan.append((last['path'], last.get('title', profile['title']), number, chapters[:room], True))
+                chapters = chapters[room:]
+        step = size or len(chapters) or 1 # Appending may have taken every chapter
+        for start in range(0, len(chapters), step):
+            number += 1
+            name, title = volume_name(profile['title'], number, size)
+            plan.append((os.path.join(out_dir, f"{name}.epub"), title, number, chapters[start:start + step], False))
+        if earlier:
+            plan.append((os.path.join(out_dir, f"{book_name(earlier)}.epub"), profile['title'], None, earlier, False))
+        return plan
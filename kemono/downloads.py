@@ -0,0 +1,141 @@
+"""The download queue: builds of any number of profiles, run side by side under one budget.
+
+Every entry is a build's DownloadJournal, so the queue is on disk from the
+moment something is added and survives restarts; a build that was
+interrupted is simply an entry again. Running builds share the client, and
+with it the per-host rate limits of its RequestScheduler (the request
+budget) and its CPU slots (see KemonoClient.cpu_slot).
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .core import Job, Cancelled
+from .net import SessionExpired
+from .journal import DownloadJournal
+
+log = logging.getLogger(__name__)
+
+QUEUE_WORKERS = 3           # Builds running at the same time
+QUEUE_POLL = 0.5            # Seconds between checks for cancellation and new entries
+
+class DownloadQueue:
+    """Runs queued builds in priority order (higher first, then oldest), up to `workers` at once.
+
+    Entries are identified by their journal's id. add(), set_priority() and
+    remove() are safe to call while run() is going; it picks the changes up.
+    """
+    def __init__(self, client, workers=QUEUE_WORKERS):
+        self.client = client
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.running = {}   # entry id -> Job of its build
+        self.removed = set() # Running entries to drop once their build has stopped
+        self.changed = threading.Event()
+
+    def entries(self):
+        """Journals of queued builds whose profile still exists, in the order they run."""
+        return sorted(self.client.pending_builds(), key=lambda j: -j.state.get('priority', 0))
+
+    def find(self, entry_id):
+        return next((j for j in self.entries() if j.state['id'] == entry_id), None)
+
+    def add(self, url, records, priority=0, output=None):
+        """Queues a build of `records` (ChapterRecords of the profile at `url`); returns its journal."""
+        journal = DownloadJournal.create(url, records, output, priority=priority, directory=self.client.journal_dir)
+        self.changed.set()
+        return journal
+
+    def set_priority(self, entry_id, priority):
+        """Only matters for entries that haven't started yet."""
+        if (journal := self.find(entry_id)) and entry_id not in self.running:
+            journal.update(priority=priority)
+            self.changed.set()
+
+    def retry(self, entry_id):
+        """Clears a failed entry's error, so it is built again (by the run going on, if there is one)."""
+        if (journal := self.find(entry_id)) and entry_id not in self.running:
+            journal.update(error=None)
+            self.changed.set()
+
+    def cancel(self, entry_id):
+        """Stops a running build; it stays queued (marked failed) and continues from where it got to."""
+        with self.lock:
+            if (job := self.running.get(entry_id)): job.cancel()
+
+    def remove(self, entry_id):
+        with self.lock:
+            if (job := self.running.get(entry_id)):
+                self.removed.add(entry_id)
+                job.cancel()
+                return
+        if (journal := self.find(entry_id)): journal.finish()
+
+    def is_running(self, entry_id):
+        return entry_id in self.running
+
+    def run(self, job=None, retry=False):
+        """Builds queued entries until none are left; returns {entry id: ([paths], image failures) or the exception}.
+
+        Entries added meanwhile are picked up too. A build that fails or is
+        cancelled on its own stays queued with its 'error' and is skipped
+        until retry() or a run with `retry`. Two builds of one profile never
+        run at once (both move its last_fetched and last volume). Progress is
+        reported as (entry id, (text, done, total)), and (entry id, None) once
+        the entry is done. Cancelling `job` stops every running build. A
+        SessionExpired stops starting new builds and is raised once the
+        running ones end.
+        """
+        job = job or Job()
+        results = {}
+        futures = {} # future -> journal
+        expired = None
+        self.changed.set()
+        try:
+            # Leaving the pool waits for running builds; after a cancel they stop at their next check
+            with ThreadPoolExecutor(self.workers) as pool:
+                while True:
+                    job.check()
+                    if self.changed.is_set() and not expired and len(futures) < self.workers:
+                        self.changed.clear()
+                        busy = {j.state['url'] for j in futures.values()}
+                        for journal in self.entries():
+                            if len(futures) == self.workers: break
+                            state = journal.state
+                            if state['url'] in busy: continue
+                            if state.get('error') and (not retry or state['id'] in results): continue
+                            busy.add(state['url'])
+                            futures[pool.submit(self.client.resume, journal, self.start(journal, job))] = journal
+                    if not futures: break
+                    done, _ = wait(futures, timeout=QUEUE_POLL, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        journal = futures.pop(future)
+                        entry_id = journal.state['id']
+                        try: results[entry_id] = result = future.result()
+                        except Exception as e:
+                            results[entry_id] = result = e
+                            if isinstance(e, SessionExpired): expired = e
+                        with self.lock:
+                            del self.running[entry_id]
+                            removed = entry_id in self.removed
+                            self.removed.discard(entry_id)
+                        stopped = isinstance(result, Cancelled) and job.cancelled # The whole run, not this entry
+                        if removed: journal.finish()
+                        elif isinstance(result, Exception) and not stopped:
+                            log.warning(f"Queued build of {journal.state['url']} failed: {result!r}")
+                            journal.update(error=str(result) or type(result).__name__)
+                        job.report((entry_id, None))
+                        self.changed.set() # A slot (and maybe a profile) is free again
+        finally:
+            with self.lock: self.running.clear()
+        if expired: raise expired
+        return results
+
+    def start(self, journal, parent):
+        """Registers an entry as running; returns the Job its build runs under."""
+        entry_id = journal.state['id']
+        job = Job(on_progress=lambda value: parent.report((entry_id, value)), parent=parent)
+        with self.lock: self.running[entry_id] = job
+        journal.state['error'] = None
+        job.report(("Starting...", 0, 0))
+        return job
@@ -0,0 +1,435 @@
+import os
+import re
+import html
+import time
+import zlib
+import uuid
+import shutil
+import struct
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+
+EPUB_STYLE = 'p { line-height: 1.2; text-indent: 0.75em; margin-bottom: 0.5em; } img { max-width: 100%; height: auto; }'
+EPUB_CONTAINER_XML = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                      '<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0"><rootfiles>'
+                      '<rootfile full-path="EPUB/content.opf" media-type="application/oebps-package+xml"/>'
+                      '</rootfiles></container>')
+
+# --- XHTML Normalization ---
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+P_CLOSING_TAGS = {'p', 'div', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'table', 'blockquote', 'pre', 'hr'}
+# Other implied end tags, as in HTML: tag -> (open tags it closes, tags that bound the search for them)
+IMPLIED_END_TAGS = {
+    'li': ({'li'}, {'ul', 'ol'}),
+    'dt': ({'dt', 'dd'}, {'dl'}),
+    'dd': ({'dt', 'dd'}, {'dl'}),
+    'td': ({'td', 'th'}, {'tr', 'table'}),
+    'th': ({'td', 'th'}, {'tr', 'table'}),
+    'tr': ({'tr'}, {'thead', 'tbody', 'tfoot', 'table'}),
+    'thead': ({'thead', 'tbody', 'tfoot'}, {'table'}),
+    'tbody': ({'thead', 'tbody', 'tfoot'}, {'table'}),
+    'tfoot': ({'thead', 'tbody', 'tfoot'}, {'table'}),
+    'option': ({'option'}, {'select', 'datalist', 'optgroup'}),
+    'optgroup': ({'optgroup'}, {'select'}),
+}
+# Dropped together with everything inside them
+DROP_TAGS = {'script', 'noscript', 'style', 'iframe', 'object', 'embed', 'form', 'template'}
+# Dropped when nothing ended up inside them (an <a> only without id/name, which make it a link target)
+EMPTY_INLINE_TAGS = {'span', 'font', 'a', 'b', 'i', 'u', 's', 'em', 'strong', 'small', 'sub', 'sup'}
+PIXEL_SIZES = {'0', '1', '0px', '1px'} # width and height of tracking pixels
+XML_NAME_RE = re.compile(r'^[A-Za-z_][-A-Za-z0-9_.]*$') # Also rules out prefixed names (o:p, svg:rect)
+# Characters XML 1.0 doesn't allow anywhere, not even escaped (control characters, lone surrogates, U+FFFE/FFFF)
+XML_INVALID_CHARS_RE = re.compile('[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]')
+OPF_NS = {'opf': 'http://www.idpf.org/2007/opf', 'dc': 'http://purl.org/dc/elements/1.1/'}
+XHTML_A = '{http://www.w3.org/1999/xhtml}a'
+METADATA_ENTRIES = ('EPUB/toc.ncx', 'EPUB/nav.xhtml', 'EPUB/content.opf') # Written last, by close()
+COMPRESS_WORKERS = min(8, os.cpu_count() or 1) # Threads deflating entries of one book
+ZIP_LEVEL = 6               # zlib's default level, as zipfile uses
+COPY_CHUNK = 1024 * 1024
+ZIP64_LIMIT = 0xFFFFFFFF
+# Formats that are compressed already; stored as is
+PRECOMPRESSED_MEDIA = {'image/jpeg', 'image/png', 'image/webp', 'image/gif'}
+
+class XhtmlNormalizer(HTMLParser):
+    """Re-serializes post HTML as well-formed XHTML in one pass.
+
+    Closes void tags, balances elements (ending <p>, <li>, <td> and the like
+    where HTML implies it) and drops HTML-only entities. On the way, <img>
+    srcs are looked up in `src_map` (keyed by the unescaped src) and
+    replaced as attributes, so nothing else in the text can be rewritten by
+    accident; scripts, embeds, tracking pixels, event handlers, comments
+    and inline elements left empty are dropped. Elements whose names aren't
+    plain XML names (Word's <o:p>) are unwrapped, and characters XML doesn't
+    allow are removed.
+    """
+    def __init__(self, src_map=None):
+        super().__init__(convert_charrefs=True)
+        self.src_map = src_map or {}
+        self.out = []
+        self.stack = []
+        self.starts = [] # Per open element: index of its start tag in out, or -1 if kept even when empty
+        self.skip = None # [tag, depth] while inside one of DROP_TAGS
+
+    def attrs(self, attrs):
+        seen = {}
+        for name, value in attrs:
+            if XML_NAME_RE.match(name) and not name.startswith('on') and name not in seen:
+                seen[name] = html.escape(XML_INVALID_CHARS_RE.sub('', name if value is None else value), quote=True)
+        return ''.join(f' {name}="{value}"' for name, value in seen.items())
+
+    def image(self, attrs):
+        """attrs of an <img> with its src rewritten, or None for a tracking pixel."""
+        values = dict(attrs)
+        if values.get('width') in PIXEL_SIZES and values.get('height') in PIXEL_SIZES: return None
+        return [(name, self.src_map.get(value, value) if name == 'src' and value else value) for name, value in attrs]
+
+    def handle_starttag(self, tag, attrs):
+        if self.skip or tag in DROP_TAGS: # Left out, and unless void everything until its end tag
+            if self.skip:
+                if tag == self.skip[0]: self.skip[1] += 1
+            elif tag not in VOID_TAGS: self.skip = [tag, 1]
+            return
+        if not XML_NAME_RE.match(tag): return # Unwrapped: its content stays, its end tag is a stray one
+        if tag == 'img' and (attrs := self.image(attrs)) is None: return
+        if tag in P_CLOSING_TAGS and self.stack and self.stack[-1] == 'p':
+            self.handle_endtag('p') # Implied </p>, as in HTML
+        if (implied := IMPLIED_END_TAGS.get(tag)):
+            closes, bounds = implied
+            for open_tag in reversed(self.stack): # <li>a<li>b is two items, not one inside the other
+                if open_tag in bounds: break
+                if open_tag in closes:
+                    self.handle_endtag(open_tag)
+                    break
+        if tag in VOID_TAGS:
+            self.out.append(f'<{tag}{self.attrs(attrs)}/>')
+        else:
+            droppable = tag in EMPTY_INLINE_TAGS and not any(name in ('id', 'name') for name, _ in attrs)
+            self.stack.append(tag)
+            self.starts.append(len(self.out) if droppable else -1)
+            self.out.append(f'<{tag}{self.attrs(attrs)}>')
+
+    def handle_startendtag(self, tag, attrs):
+        if self.skip or tag in DROP_TAGS or not XML_NAME_RE.match(tag): return
+        if tag == 'img' and (attrs := self.image(attrs)) is None: return
+        self.out.append(f'<{tag}{self.attrs(attrs)}/>')
+
+    def handle_endtag(self, tag):
+        if self.skip:
+            if tag == self.skip[0]:
+                self.skip[1] -= 1
+                if not self.skip[1]: self.skip = None
+            return
+        if tag not in self.stack: return # Stray closing tag
+        while self.stack:
+            if self.close_top() == tag: break
+
+    def close_top(self):
+        open_tag = self.stack.pop()
+        if self.starts.pop() == len(self.out) - 1: self.out.pop() # Left empty
+        else: self.out.append(f'</{open_tag}>')
+        return open_tag
+
+    def handle_data(self, data):
+        if not self.skip: self.out.append(html.escape(XML_INVALID_CHARS_RE.sub('', data), quote=False))
+
+    def result(self):
+        self.close()
+        while self.stack: self.close_top()
+        return ''.join(self.out)
+
+def to_xhtml(body, src_map=None):
+    parser = XhtmlNormalizer(src_map)
+    parser.feed(body or '')
+    return parser.result()
+
+# --- Zip Output ---
+class ZipEntry:
+    """Central directory record of one written entry."""
+    __slots__ = ('name', 'flags', 'method', 'crc', 'compressed_size', 'size', 'offset', 'dos_time', 'dos_date')
+
+    def __init__(self, name, flags, method, crc, compressed_size, size, offset, dos_time, dos_date):
+        self.name, self.flags, self.method, self.crc = name, flags, method, crc
+        self.compressed_size, self.size, self.offset = compressed_size, size, offset
+        self.dos_time, self.dos_date = dos_time, dos_date
+
+def dos_datetime(t):
+    """(time, date) fields of a zip header for a struct_time / ZipInfo.date_time tuple."""
+    year, month, day, hour, minute, second = t[:6]
+    return (hour << 11) | (minute << 5) | (second // 2), (max(year, 1980) - 1980) << 9 | (month << 5) | day
+
+def deflate(data, level=ZIP_LEVEL):
+    """(crc, size, raw deflate stream) of `data`; runs in a worker thread, zlib releases the GIL."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return zlib.crc32(data), len(data), compressor.compress(data) + compressor.flush()
+
+def file_crc(path):
+    crc, size = 0, 0
+    with open(path, "rb") as f:
+        while (chunk := f.read(COPY_CHUNK)):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+    return crc, size
+
+class ZipWriter:
+    """Writes zip entries whose data was compressed (or checksummed) elsewhere.
+
+    zipfile can only compress an entry while writing it, which serializes the
+    whole book on one core. Here every entry arrives with its CRC and sizes
+    already known, so the local header can be written up front and no data
+    descriptors are needed. Zip64 records are only written when the book
+    grows past the classic 4 GB / 65535 entry limits.
+    """
+    def __init__(self, fp, entries=(), when=None):
+        self.fp = fp
+        self.entries = list(entries)
+        self.dos_time, self.dos_date = dos_datetime(when or time.localtime())
+
+    def header(self, entry):
+        zip64 = entry.size >= ZIP64_LIMIT or entry.compressed_size >= ZIP64_LIMIT
+        extra = struct.pack('<HHQQ', 1, 16, entry.size, entry.compressed_size) if zip64 else b''
+        sizes = (0xFFFFFFFF, 0xFFFFFFFF) if zip64 else (entry.compressed_size, entry.size)
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, entry.flags, entry.method,
+                           entry.dos_time, entry.dos_date, entry.crc, *sizes, len(entry.name), len(extra)) + entry.name + extra
+
+    def start(self, name, method, crc, compressed_size, size):
+        encoded = name.encode('utf-8')
+        flags = 0 if encoded.isascii() else 0x800 # UTF-8 file name
+        entry = ZipEntry(encoded, flags, method, crc, compressed_size, size, self.fp.tell(), self.dos_time, self.dos_date)
+        self.fp.write(self.header(entry))
+        self.entries.append(entry)
+
+    def write(self, name, data, method=zipfile.ZIP_DEFLATED):
+        """Compresses and writes a small entry in this thread (metadata documents)."""
+        data = data.encode('utf-8') if isinstance(data, str) else data
+        if method == zipfile.ZIP_STORED: crc, size, payload = zlib.crc32(data), len(data), data
+        else: crc, size, payload = deflate(data)
+        self.write_compressed(name, method, crc, size, payload)
+
+    def write_compressed(self, name, method, crc, size, payload):
+        self.start(name, method, crc, len(payload), size)
+        self.fp.write(payload)
+
+    def write_file(self, name, path, crc, size):
+        """Copies the file at `path` into a STORED entry in chunks."""
+        self.start(name, zipfile.ZIP_STORED, crc, size, size)
+        with open(path, "rb") as src: shutil.copyfileobj(src, self.fp, COPY_CHUNK)
+
+    def finish(self):
+        """Writes the central directory; the zip is complete afterwards."""
+        cd_start = self.fp.tell()
+        field = lambda v: 0xFFFFFFFF if v >= ZIP64_LIMIT else v
+        for e in self.entries:
+            # The zip64 extra holds, in this order, whichever of size / compressed size / offset overflowed
+            big = [v for v in (e.size, e.compressed_size, e.offset) if v >= ZIP64_LIMIT]
+            extra = struct.pack(f'<HH{len(big)}Q', 1, 8 * len(big), *big) if big else b''
+            version = 45 if big else 20
+            self.fp.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, version, version, e.flags, e.method,
+                                      e.dos_time, e.dos_date, e.crc, field(e.compressed_size), field(e.size),
+                                      len(e.name), len(extra), 0, 0, 0, 0, field(e.offset)) + e.name + extra)
+        cd_end = self.fp.tell()
+        count, cd_size = len(self.entries), cd_end - cd_start
+        if count >= 0xFFFF or cd_start >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+            self.fp.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_start))
+            self.fp.write(struct.pack('<IIQI', 0x07064b50, 0, cd_end, 1))
+            count, cd_size, cd_start = min(count, 0xFFFF), field(cd_size), field(cd_start)
+        self.fp.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, cd_size, cd_start, 0))
+
+# --- EPUB Writer ---
+class EpubWriter:
+    """Writes an EPUB 3 file incrementally instead of assembling the whole book in memory.
+
+    Entries are compressed by a pool of threads and written to the file in the
+    order they were added, with only a few in flight at once, so memory use
+    stays flat and build time scales with cores. Images in formats that are
+    already compressed are stored as they are. The OPF, NCX and nav documents
+    are written by close(), once the manifest is complete. The book is built
+    under a temporary name and only moved into place when closed
+    successfully.
+
+    With append=True an existing book written by this class is extended
+    instead: its entries are kept byte for byte, new chapters go after them
+    and only the OPF, NCX and nav documents are rewritten.
+    """
+    def __init__(self, path, title, author, lang='en', append=False, workers=COMPRESS_WORKERS):
+        self.path = path
+        self.tmp_path = f"{path}.part"
+        self.title = title
+        self.author = author
+        self.lang = lang
+        self.uid = f"urn:uuid:{uuid.uuid4()}"
+        self.manifest = [] # (id, href, media_type, properties)
+        self.spine = []
+        self.toc = []      # (href, title)
+        self.hrefs = set()
+        self.item_ids = set()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.pending = deque() # (write function, future), oldest first
+        self.max_pending = 2 * max(1, workers)
+        if append and os.path.exists(path):
+            self.reopen()
+            return
+        self.fp = open(self.tmp_path, "wb")
+        self.zip = ZipWriter(self.fp)
+        # mimetype has to be the first entry, uncompressed
+        self.zip.write("mimetype", "application/epub+zip", method=zipfile.ZIP_STORED)
+        self.zip.write("META-INF/container.xml", EPUB_CONTAINER_XML)
+
+    def reopen(self):
+        """Loads manifest, spine and toc of the existing book and drops its metadata entries."""
+        try:
+            with zipfile.ZipFile(self.path) as old:
+                opf = ElementTree.fromstring(old.read('EPUB/content.opf'))
+                self.uid = opf.find('opf:metadata/dc:identifier', OPF_NS).text # Readers keep it as the same book
+                for item in opf.find('opf:manifest', OPF_NS):
+                    if item.get('id') in ('ncx', 'nav'): continue
+                    self.manifest.append((item.get('id'), item.get('href'), item.get('media-type'), item.get('properties')))
+                    self.hrefs.add(item.get('href'))
+                    self.item_ids.add(item.get('id'))
+                self.spine = [ref.get('idref') for ref in opf.find('opf:spine', OPF_NS) if ref.get('idref') != 'nav']
+                nav = ElementTree.fromstring(old.read('EPUB/nav.xhtml'))
+                self.toc = [(a.get('href'), ''.join(a.itertext())) for a in nav.iter(XHTML_A)]
+                infos = old.infolist()
+            if (start := self.metadata_start(infos)) is None:
+                raise ValueError(f"{self.path} was not written by this program, can't append to it")
+            kept = [info for info in infos if info.filename not in METADATA_ENTRIES]
+        except Exception:
+            self.pool.shutdown()
+            raise
+        # Everything before the old metadata is copied as is; new entries are written from there
+        with open(self.path, "rb") as src, open(self.tmp_path, "wb") as dst:
+            left = start
+            while left and (chunk := src.read(min(left, COPY_CHUNK))):
+                dst.write(chunk)
+                left -= len(chunk)
+        self.fp = open(self.tmp_path, "r+b")
+        self.fp.seek(start)
+        self.zip = ZipWriter(self.fp, [ZipEntry(info.filename.encode('utf-8'), info.flag_bits, info.compress_type,
+                                                info.CRC, info.compress_size, info.file_size, info.header_offset,
+                                                *dos_datetime(info.date_time)) for info in kept])
+
+    @staticmethod
+    def metadata_start(infos):
+        """Where the metadata entries among a book's ZipInfos start, or None unless they all come last, as close() writes them."""
+        metadata = [info for info in infos if info.filename in METADATA_ENTRIES]
+        if len(metadata) != len(METADATA_ENTRIES): return None
+        start = min(info.header_offset for info in metadata)
+        if any(info.header_offset > start for info in infos if info not in metadata): return None
+        return start
+
+    @staticmethod
+    def chapter_count(path):
+        """Number of chapters in a book written by this class, or None if it can't be read or appended to."""
+        try:
+            with zipfile.ZipFile(path) as book:
+                if EpubWriter.metadata_start(book.infolist()) is None: return None
+                opf = ElementTree.fromstring(book.read('EPUB/content.opf'))
+            return sum(1 for ref in opf.find('opf:spine', OPF_NS) if ref.get('idref') != 'nav')
+        except (OSError, KeyError, zipfile.BadZipFile, ElementTree.ParseError): return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None: self.close()
+        else: self.abort()
+
+    def unique_href(self, href):
+        base, ext = os.path.splitext(href)
+        n = 1
+        while href in self.hrefs:
+            n += 1
+            href = f"{base}_{n}{ext}"
+        self.hrefs.add(href)
+        return href
+
+    def new_id(self):
+        n = len(self.manifest)
+        while f"item_{n}" in self.item_ids: n += 1
+        self.item_ids.add(f"item_{n}")
+        return f"item_{n}"
+
+    def enqueue(self, write, fn, *args):
+        """Runs fn(*args) on the pool; write(result) is called in order once its turn comes."""
+        self.pending.append((write, self.pool.submit(fn, *args)))
+        while len(self.pending) > self.max_pending: self.flush_one()
+
+    def flush_one(self):
+        write, future = self.pending.popleft()
+        write(future.result())
+
+    def add_item(self, href, media_type, data=None, source=None, properties=None):
+        """Adds bytes/str `data`, or streams the file at `source` in chunks. Returns the href used."""
+        item_id = self.new_id()
+        href = self.unique_href(href)
+        self.manifest.append((item_id, href, media_type, properties))
+        name = f"EPUB/{href}"
+        if source is not None and media_type in PRECOMPRESSED_MEDIA:
+            # Deflating JPEG/PNG/WebP/GIF costs time and saves nothing: only checksum them
+            self.enqueue(lambda result: self.zip.write_file(name, source, *result), file_crc, source)
+            return href
+        if source is not None:
+            with open(source, "rb") as f: data = f.read()
+        data = data.encode('utf-8') if isinstance(data, str) else data
+        self.enqueue(lambda result: self.zip.write_compressed(name, zipfile.ZIP_DEFLATED, *result), deflate, data)
+        return href
+
+    def add_chapter(self, href, title, body):
+        """Writes a chapter document; `body` is already well-formed XHTML."""
+        doc = (f'<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+               f'<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" '
+               f'lang="{self.lang}" xml:lang="{self.lang}">\n'
+               f'<head><title>{html.escape(title)}</title>'
+               f'<link href="style.css" rel="stylesheet" type="text/css"/></head>\n'
+               f'<body>{body}</body>\n</html>\n')
+        href = self.add_item(href, "application/xhtml+xml", data=doc.encode("utf-8"))
+        self.spine.append(self.manifest[-1][0])
+        self.toc.append((href, title))
+        return href
+
+    def close(self):
+        while self.pending: self.flush_one()
+        self.pool.shutdown()
+        uid = self.uid
+        esc = html.escape
+        nav_points = ''.join(
+            f'<navPoint id="np{i}" playOrder="{i}"><navLabel><text>{esc(t)}</text></navLabel>'
+            f'<content src="{esc(h)}"/></navPoint>' for i, (h, t) in enumerate(self.toc, 1))
+        self.zip.write("EPUB/toc.ncx",
+            f'<?xml version="1.0" encoding="utf-8"?>\n<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            f'<head><meta name="dtb:uid" content="{uid}"/></head><docTitle><text>{esc(self.title)}</text></docTitle>'
+            f'<navMap>{nav_points}</navMap></ncx>')
+        nav_items = ''.join(f'<li><a href="{esc(h)}">{esc(t)}</a></li>' for h, t in self.toc)
+        self.zip.write("EPUB/nav.xhtml",
+            f'<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+            f'<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="{self.lang}">'
+            f'<head><title>{esc(self.title)}</title></head><body><nav epub:type="toc" id="id"><h2>{esc(self.title)}</h2>'
+            f'<ol>{nav_items}</ol></nav></body></html>')
+        manifest = ''.join(
+            f'<item id="{i}" href="{esc(h)}" media-type="{m}"{f" properties={chr(34)}{p}{chr(34)}" if p else ""}/>'
+            for i, h, m, p in self.manifest)
+        spine = ''.join(f'<itemref idref="{i}"/>' for i in self.spine)
+        modified = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        self.zip.write("EPUB/content.opf",
+            f'<?xml version="1.0" encoding="utf-8"?>\n'
+            f'<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="id" version="3.0">'
+            f'<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            f'<dc:identifier id="id">{uid}</dc:identifier><dc:title>{esc(self.title)}</dc:title>'
+            f'<dc:language>{self.lang}</dc:language><dc:creator>{esc(self.author)}</dc:creator>'
+            f'<meta property="dcterms:modified">{modified}</meta></metadata>'
+            f'<manifest><item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+            f'<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>{manifest}</manifest>'
+            f'<spine toc="ncx"><itemref idref="nav"/>{spine}</spine></package>')
+        self.zip.finish()
+        self.fp.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        for _, future in self.pending: future.cancel()
+        self.pending.clear()
+        self.pool.shutdown()
+        self.fp.close()
+        try: os.remove(self.tmp_path)
+        except OSError: pass
@@ -0,0 +1,960 @@
+import logging
+import sys
+
+from PyQt6.QtWidgets import (
+    QMainWindow, QApplication, QVBoxLayout, QHBoxLayout, QWidget, QPushButton,
+    QTreeWidget, QTreeWidgetItem, QTreeView, QLabel, QMenu, QFileDialog, QSpinBox, QCheckBox,
+    QDateEdit, QDialog, QMessageBox, QFormLayout, QLineEdit, QAbstractItemView
+)
+from PyQt6.QtCore import (Qt, QObject, QRunnable, QThreadPool, QTimer, QAbstractTableModel, QModelIndex,
+                          QDate, pyqtSignal)
+from PyQt6.QtGui import QColor
+
+from .core import KemonoClient, Job, Cancelled, SessionExpired, ApiError, ChapterRecord, PAGE_SIZE
+from .downloads import DownloadQueue
+
+MAX_BACKGROUND_JOBS = 4     # Previews/downloads that may run at the same time
+STATS_REFRESH_MS = 1000
+
+# --- Background Jobs ---
+class WorkerSignals(QObject):
+    progress = pyqtSignal(object)
+    result = pyqtSignal(object)
+    error = pyqtSignal(object)
+    finished = pyqtSignal()
+
+class Worker(QRunnable):
+    """Runs fn(*args, job=..., **kwargs) on a QThreadPool and reports back through signals.
+
+    The function receives a core Job: job.report(value) emits progress and
+    job.check() stops it with Cancelled once cancel() has been requested.
+    Signals are delivered on the GUI thread; a cancelled job emits no result.
+    """
+    def __init__(self, fn, *args, **kwargs):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = WorkerSignals()
+        self.job = Job(on_progress=self.signals.progress.emit)
+
+    @property
+    def cancelled(self):
+        return self.job.cancelled
+
+    def cancel(self):
+        self.job.cancel()
+
+    def run(self):
+        try:
+            result = self.fn(*self.args, job=self.job, **self.kwargs)
+            if not self.cancelled: self.signals.result.emit(result)
+        except Cancelled: pass
+        except Exception as e: self.signals.error.emit(e)
+        finally: self.signals.finished.emit()
+
+# --- Preview Model ---
+class ChapterListModel(QAbstractTableModel):
+    """Preview rows backed by compact ChapterRecords, paged in as the view scrolls.
+
+    When the view reaches the last row it calls fetchMore(), which asks
+    fetch_page(offset, on_loaded, on_failed) for the next page; only one page
+    request is in flight at a time. Bodies are never held here, they stay in
+    the post cache until a build loads them.
+    """
+    state_changed = pyqtSignal()
+    HEADERS = ("Title", "Date")
+    NEW_COLOR = QColor(200, 255, 200)
+
+    def __init__(self, records, next_offset, last_fetched, fetch_page, parent=None):
+        super().__init__(parent)
+        self.records = []
+        self.ids = set()
+        self.next_offset = next_offset
+        self.last_fetched = last_fetched
+        self.fetch_page = fetch_page
+        self.loading = False
+        self.exhausted = False
+        self.error = None
+        self.append(records)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.records)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return self.HEADERS[section]
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        record = self.records[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return record.title if index.column() == 0 else record.published
+        if role == Qt.ItemDataRole.BackgroundRole and index.column() == 0 and record.published > self.last_fetched:
+            return self.NEW_COLOR # Highlight new
+        if role == Qt.ItemDataRole.UserRole:
+            return record.id
+
+    def append(self, records):
+        # Pages past the cached range can repeat posts that are already listed
+        new = []
+        for record in records:
+            if record.id in self.ids: continue
+            self.ids.add(record.id)
+            new.append(record)
+        if not new: return
+        self.beginInsertRows(QModelIndex(), len(self.records), len(self.records) + len(new) - 1)
+        self.records.extend(new)
+        self.endInsertRows()
+
+    def page_loaded(self, offset, posts):
+        self.next_offset = max(self.next_offset, offset + PAGE_SIZE)
+        self.append(ChapterRecord.from_post(p) for p in posts)
+        if len(posts) < PAGE_SIZE: self.exhausted = True
+        self.state_changed.emit()
+
+    def set_loading(self, loading, error=None):
+        self.loading = loading
+        self.error = error
+        self.state_changed.emit()
+
+    def canFetchMore(self, parent=QModelIndex()):
+        # After a failure the view would retry on every scroll; wait for an explicit retry instead
+        return not parent.isValid() and not (self.loading or self.exhausted or self.error)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent): return
+        offset = self.next_offset
+        self.set_loading(True)
+        def loaded(posts):
+            self.set_loading(False)
+            self.page_loaded(offset, posts)
+        self.fetch_page(offset, loaded, lambda error: self.set_loading(False, error))
+
+    def retry(self):
+        self.error = None
+        self.fetchMore()
+
+    def status(self):
+        count = f"{len(self.records):,} chapter(s)"
+        if self.loading: return f"{count}, loading..."
+        if self.error: return f"{count}, loading failed"
+        if self.exhausted: return f"{count}, all loaded"
+        return f"{count}, scroll down for more"
+
+# --- Login Dialog ---
+class LoginWindow(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Login to Kemono")
+        self.setModal(True)
+        self.resize(300, 150)
+        
+        layout = QVBoxLayout(self)
+        form = QFormLayout()
+        self.username_input = QLineEdit()
+        self.password_input = QLineEdit()
+        self.password_input.setEchoMode(QLineEdit.EchoMode.Password)
+        
+        form.addRow("Username:", self.username_input)
+        form.addRow("Password:", self.password_input)
+        layout.addLayout(form)
+
+        btn_layout = QHBoxLayout()
+        self.login_button = QPushButton("Login")
+        self.cancel_button = QPushButton("Cancel")
+        
+        self.login_button.clicked.connect(self.attempt_login)
+        self.cancel_button.clicked.connect(self.reject)
+        
+        btn_layout.addWidget(self.login_button)
+        btn_layout.addWidget(self.cancel_button)
+        layout.addLayout(btn_layout)
+
+    def attempt_login(self):
+        username = self.username_input.text().strip()
+        password = self.password_input.text().strip()
+        if not username or not password:
+            QMessageBox.warning(self, "Error", "Please enter credentials.")
+            return
+        if self.parent().login_to_kemono(username, password):
+            self.accept()
+
+# --- Stats Panel ---
+class StatsWindow(QDialog):
+    """Live view of the client's metrics, with JSON / Prometheus export."""
+    def __init__(self, metrics, parent=None):
+        super().__init__(parent)
+        self.metrics = metrics
+        self.setWindowTitle("Stats")
+        self.resize(460, 520)
+
+        layout = QVBoxLayout(self)
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(["Metric", "Value"])
+        self.tree.setColumnWidth(0, 220)
+        layout.addWidget(self.tree)
+
+        btn_layout = QHBoxLayout()
+        for label, slot in (("Export JSON", self.export_json), ("Export Prometheus", self.export_prometheus),
+                            ("Reset", self.reset)):
+            btn = QPushButton(label)
+            btn.clicked.connect(slot)
+            btn_layout.addWidget(btn)
+        layout.addLayout(btn_layout)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(STATS_REFRESH_MS)
+        self.refresh()
+
+    def refresh(self):
+        snap = self.metrics.snapshot()
+        self.tree.clear()
+        general = QTreeWidgetItem(self.tree, ["General"])
+        QTreeWidgetItem(general, ["Since", snap['since']])
+        if snap['peak_rss_bytes']:
+            QTreeWidgetItem(general, ["Peak memory", f"{snap['peak_rss_bytes'] / 2**20:.0f} MB"])
+        counters = QTreeWidgetItem(self.tree, ["Counters"])
+        for name, value in snap['counters'].items():
+            shown = f"{value / 2**20:.1f} MB" if name.endswith('bytes') else str(value)
+            QTreeWidgetItem(counters, [name, shown])
+        phases = QTreeWidgetItem(self.tree, ["Timings"])
+        for name, p in snap['phases'].items():
+            QTreeWidgetItem(phases, [name, f"{p['seconds']:.2f}s / {p['calls']} (max {p['max_seconds']:.2f}s)"])
+        self.tree.expandAll()
+
+    def export_json(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export Metrics", "metrics.json", "JSON (*.json)")
+        if path: self.metrics.write_json(path)
+
+    def export_prometheus(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export Metrics", "kemono.prom", "Prometheus textfile (*.prom)")
+        if path: self.metrics.write_prometheus(path)
+
+    def reset(self):
+        self.metrics.reset()
+        self.refresh()
+
+# --- Main Window ---
+class KemonoWebnovelDownloader(QMainWindow):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("Kemono Webnovel Downloader")
+        self.setGeometry(100, 100, 600, 500)
+        
+        central_widget = QWidget()
+        self.setCentralWidget(central_widget)
+        self.layout = QVBoxLayout(central_widget)
+        
+        self.setup_styles()
+        
+        self.client = KemonoClient()
+        
+        # State for preview pagination
+        self.current_preview_url = None
+        self.preview_model = None
+        self.preview_view = None
+        self.preview_dialog = None
+        self.preview_jobs = []
+        self.stats_window = None
+
+        # Download queue; its run() is one background job while there is work
+        self.queue = DownloadQueue(self.client)
+        self.queue_job = None
+        self.queue_status = {} # entry id -> progress text of running builds
+        self.queue_failed = False
+        
+        self.thread_pool = QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(MAX_BACKGROUND_JOBS)
+        self.jobs = set()
+        
+        self.setup_ui()
+        self.load_profiles()
+        self.update_profile_list()
+        self.update_queue_list()
+        QTimer.singleShot(0, self.offer_resume)
+
+        if self.client.logged_in:
+            self.update_ui_for_login(reload=False) # The profiles above are already being revalidated
+
+    def setup_styles(self):
+        self.setStyleSheet("""
+            QWidget { background-color: #dbdbdb; font-size: 13px; }
+            QPushButton {
+                background-color: #4287f5; border: none; color: white;
+                padding: 8px 16px; border-radius: 4px; font-weight: bold;
+            }
+            QPushButton:hover { background-color: #1064e8; }
+            QPushButton:disabled { background-color: #cccccc; color: #666666; }
+            QTreeWidget {
+                background-color: #ffffff; color: black; border-radius: 4px;
+            }
+            QLineEdit {
+                background-color: #ffffff; border: 1px solid #cccccc; padding: 4px; border-radius: 4px;
+            }
+        """)
+
+    def setup_ui(self):
+        # Top Controls
+        top_layout = QHBoxLayout()
+        ctrl_btn_style = "QPushButton { background-color: #333; }"
+        
+        btn_defaults = QPushButton("Defaults")
+        btn_defaults.setStyleSheet(ctrl_btn_style)
+        btn_defaults.clicked.connect(self.open_defaults_window)
+        
+        btn_refresh = QPushButton("Refresh")
+        btn_refresh.setStyleSheet(ctrl_btn_style)
+        btn_refresh.clicked.connect(self.refresh)
+        
+        btn_stats = QPushButton("Stats")
+        btn_stats.setStyleSheet(ctrl_btn_style)
+        btn_stats.clicked.connect(self.open_stats_window)
+        
+        self.btn_login = QPushButton("Login")
+        self.btn_login.setStyleSheet(ctrl_btn_style)
+        self.btn_login.clicked.connect(self.open_login_window)
+        
+        self.btn_logout = QPushButton("Logout")
+        self.btn_logout.setStyleSheet(ctrl_btn_style)
+        self.btn_logout.clicked.connect(self.logout)
+        self.btn_logout.setVisible(False)
+        
+        top_layout.addWidget(btn_defaults)
+        top_layout.addWidget(btn_refresh)
+        top_layout.addWidget(btn_stats)
+        top_layout.addStretch()
+        top_layout.addWidget(self.btn_login)
+        top_layout.addWidget(self.btn_logout)
+        self.layout.addLayout(top_layout)
+
+        # Profile List
+        self.profile_list = QTreeWidget()
+        self.profile_list.setHeaderLabels(["Title", "Author", "URL", "New"])
+        self.profile_list.setColumnWidth(0, 200)
+        self.profile_list.setColumnHidden(2, True)
+        self.profile_list.itemSelectionChanged.connect(self.update_button_state)
+        self.profile_list.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.profile_list.customContextMenuRequested.connect(self.show_context_menu)
+        self.layout.addWidget(self.profile_list)
+
+        # Action Buttons
+        act_layout = QHBoxLayout()
+        btn_add = QPushButton("Add Profile")
+        btn_add.clicked.connect(self.add_profile)
+        
+        self.btn_dl_preview = QPushButton("Preview & Download")
+        self.btn_dl_preview.clicked.connect(self.preview_chapters)
+        self.btn_dl_preview.setEnabled(False)
+        
+        self.btn_check = QPushButton("Check for Updates")
+        self.btn_check.clicked.connect(self.check_updates)
+        
+        act_layout.addWidget(btn_add)
+        act_layout.addWidget(self.btn_check)
+        act_layout.addWidget(self.btn_dl_preview)
+        self.layout.addLayout(act_layout)
+
+        # Download Queue
+        queue_layout = QHBoxLayout()
+        queue_layout.addWidget(QLabel("Downloads"))
+        queue_layout.addStretch()
+        self.btn_queue = QPushButton("Start")
+        self.btn_queue.setStyleSheet(ctrl_btn_style)
+        self.btn_queue.clicked.connect(self.toggle_queue)
+        queue_layout.addWidget(self.btn_queue)
+        self.layout.addLayout(queue_layout)
+
+        self.queue_list = QTreeWidget()
+        self.queue_list.setHeaderLabels(["Title", "Chapters", "Priority", "Status", "ID"])
+        self.queue_list.setColumnWidth(0, 200)
+        self.queue_list.setColumnHidden(4, True)
+        self.queue_list.setRootIsDecorated(False)
+        self.queue_list.setMaximumHeight(160)
+        self.queue_list.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.queue_list.customContextMenuRequested.connect(self.show_queue_menu)
+        self.layout.addWidget(self.queue_list)
+
+    def closeEvent(self, event):
+        for job in list(self.jobs): job.cancel()
+        super().closeEvent(event)
+
+    # --- Background Jobs ---
+
+    def start_job(self, fn, *args, on_result=None, on_progress=None, on_error=None, on_finished=None, **kwargs):
+        """Runs fn on the thread pool; callbacks are invoked on the GUI thread."""
+        job = Worker(fn, *args, **kwargs)
+        if on_result: job.signals.result.connect(on_result)
+        if on_progress: job.signals.progress.connect(lambda value: job.cancelled or on_progress(value))
+        job.signals.error.connect(on_error or self.job_failed)
+        job.signals.finished.connect(lambda: self.job_finished(job, on_finished))
+        self.jobs.add(job)
+        self.update_job_status()
+        self.thread_pool.start(job)
+        return job
+
+    def job_finished(self, job, callback=None):
+        self.jobs.discard(job)
+        self.update_job_status()
+        if callback: callback()
+
+    def job_failed(self, error):
+        if isinstance(error, SessionExpired): self.handle_session_expiry()
+        else: QMessageBox.critical(self, "Error", str(error))
+
+    def update_job_status(self):
+        count = len(self.jobs)
+        self.statusBar().showMessage(f"{count} background job(s) running" if count else "")
+
+    # --- Data & Auth ---
+
+    def open_login_window(self):
+        LoginWindow(self).exec()
+
+    def login_to_kemono(self, username, password):
+        try:
+            self.client.login(username, password)
+            self.update_ui_for_login()
+            QMessageBox.information(self, "Success", "Logged in successfully!")
+            return True
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Login failed: {e}")
+            return False
+
+    def logout(self):
+        self.client.clear_session()
+        self.update_ui_for_logout()
+
+    def update_ui_for_login(self, reload=True):
+        self.btn_login.setVisible(False)
+        self.btn_logout.setVisible(True)
+        if reload:
+            self.load_profiles()
+            self.update_profile_list()
+
+    def update_ui_for_logout(self):
+        self.btn_login.setVisible(True)
+        self.btn_logout.setVisible(False)
+        self.refresh()
+
+    def handle_session_expiry(self):
+        self.logout()
+        QMessageBox.warning(self, "Session Expired", "Please log in again.")
+
+    def load_profiles(self):
+        # Logged in, the list shows the favorites snapshot right away and is revalidated in the background
+        self.client.load_profiles(revalidate=False)
+        self.revalidate_profiles()
+        return self.client.profiles
+
+    def revalidate_profiles(self, force=False, on_done=None):
+        if not self.client.logged_in: return
+        def revalidated(favorites):
+            if favorites is not None: self.update_profile_list(self.client.apply_favorites(favorites))
+            if on_done: on_done()
+        self.start_job(self.client.revalidate_favorites, force=force, on_result=revalidated)
+
+    def refresh(self):
+        done = lambda: QMessageBox.information(self, "Refreshed", "Profiles reloaded.")
+        if self.client.logged_in:
+            self.revalidate_profiles(force=True, on_done=done)
+            return
+        self.load_profiles()
+        self.update_profile_list()
+        done()
+
+    def update_profile_list(self, urls=None):
+        """Brings the rows in line with client.profiles, patching them in place; `urls` limits it to those profiles."""
+        tree = self.profile_list
+        profiles = self.client.profiles
+        rows = {tree.topLevelItem(i).text(2): tree.topLevelItem(i) for i in range(tree.topLevelItemCount())}
+        for url in [url for url in rows if url not in profiles and (urls is None or url in urls)]:
+            tree.takeTopLevelItem(tree.indexOfTopLevelItem(rows.pop(url)))
+        for url, p in profiles.items():
+            if not (item := rows.get(url)):
+                item = rows[url] = QTreeWidgetItem(["", "", url, ""])
+                tree.addTopLevelItem(item)
+            elif urls is not None and url not in urls: continue
+            item.setText(0, p['title'])
+            item.setText(1, p['author'])
+            # Counts from an earlier check still hold until the profile is downloaded again
+            check = self.client.update_checks.get(url)
+            if check and check[1] == p.get('last_fetched', ''): self.show_new_count(item, *check[2])
+            else: item.setText(3, "")
+        # Most recently updated first; only rows that are out of place move
+        order = sorted(profiles, key=lambda url: profiles[url].get('updated', ''), reverse=True)
+        for i, url in enumerate(order):
+            if tree.topLevelItem(i) is not rows[url]:
+                tree.insertTopLevelItem(i, tree.takeTopLevelItem(tree.indexOfTopLevelItem(rows[url])))
+
+    def show_new_count(self, item, count, exact):
+        item.setText(3, f"{count}" if exact else f"{count}+")
+        font = item.font(3)
+        font.setBold(count > 0)
+        item.setFont(3, font)
+
+    def check_updates(self):
+        self.btn_check.setEnabled(False)
+        self.btn_check.setText("Checking...")
+        items = {self.profile_list.topLevelItem(i).text(2): self.profile_list.topLevelItem(i)
+                 for i in range(self.profile_list.topLevelItemCount())}
+
+        def checked(value):
+            url, count, exact = value
+            if url in items: self.show_new_count(items[url], count, exact)
+
+        summary = []
+        def done(result):
+            counts, failures = result
+            for url, error in failures.items():
+                if url in items:
+                    items[url].setText(3, "?")
+                    items[url].setToolTip(3, error)
+            updated = sum(1 for count, _ in counts.values() if count)
+            summary.append(f"{updated} profile(s) with new chapters"
+                           + (f", {len(failures)} could not be checked" if failures else ""))
+
+        def finished():
+            self.btn_check.setEnabled(True)
+            self.btn_check.setText("Check for Updates")
+            # After the job count in the status bar has been cleared
+            if summary: self.statusBar().showMessage(summary[0], 10000)
+
+        self.start_job(self.client.check_updates, on_progress=checked, on_result=done, on_finished=finished)
+
+    def update_button_state(self):
+        self.btn_dl_preview.setEnabled(bool(self.profile_list.selectedItems()))
+
+    def show_context_menu(self, pos):
+        item = self.profile_list.itemAt(pos)
+        if not item: return
+        menu = QMenu(self)
+        menu.addAction("Download Date Range...", self.download_date_range)
+        menu.addAction("Edit Profile", self.edit_profile)
+        menu.addAction("Delete Profile", self.delete_profile)
+        menu.exec(self.profile_list.mapToGlobal(pos))
+
+    # --- Profile Mgmt ---
+
+    def add_profile(self):
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Add Profile")
+        layout = QVBoxLayout(dialog)
+        form = QFormLayout()
+        url_input = QLineEdit()
+        title_input = QLineEdit()
+        author_input = QLineEdit()
+        form.addRow("URL:", url_input)
+        form.addRow("Title:", title_input)
+        form.addRow("Author:", author_input)
+        layout.addLayout(form)
+        btn = QPushButton("Add")
+        
+        def submit():
+            api_url = self.client.fix_link(url_input.text())
+            if not api_url:
+                QMessageBox.critical(dialog, "Error", "Invalid URL.")
+                return
+            if api_url in self.client.profiles:
+                QMessageBox.warning(dialog, "Exists", "Profile already exists.")
+                return
+            
+            if self.client.logged_in:
+                try:
+                    self.client.add_favorite(api_url)
+                    self.refresh()
+                    dialog.accept()
+                except Exception as e:
+                    QMessageBox.critical(dialog, "Error", str(e))
+            else:
+                self.client.profiles[api_url] = {
+                    "title": title_input.text() or "Unknown",
+                    "author": author_input.text() or "Unknown",
+                    "directory": self.client.default_directory,
+                    "last_fetched": ""
+                }
+                self.client.save_profile(api_url)
+                self.update_profile_list()
+                dialog.accept()
+
+        btn.clicked.connect(submit)
+        layout.addWidget(btn)
+        dialog.exec()
+
+    def edit_profile(self):
+        item = self.profile_list.currentItem()
+        if not item: return
+        url = item.text(2)
+        profile = self.client.profiles[url]
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Edit Profile")
+        layout = QVBoxLayout(dialog)
+        form = QFormLayout()
+        t_in = QLineEdit(profile.get('title', ''))
+        a_in = QLineEdit(profile.get('author', ''))
+        v_in = QSpinBox()
+        v_in.setRange(0, 100000)
+        v_in.setSpecialValueText("One book per download")
+        v_in.setValue(int(profile.get('volume_size') or 0))
+        ap_in = QCheckBox("Append new chapters to the last volume")
+        ap_in.setChecked(bool(profile.get('append')))
+        form.addRow("Title:", t_in)
+        form.addRow("Author:", a_in)
+        form.addRow("Chapters per volume:", v_in)
+        form.addRow("", ap_in)
+        layout.addLayout(form)
+        btn = QPushButton("Save")
+        def save():
+            profile['title'] = t_in.text()
+            profile['author'] = a_in.text()
+            profile['volume_size'] = v_in.value()
+            profile['append'] = ap_in.isChecked()
+            self.client.save_profile(url, 'title', 'author', 'volume_size', 'append')
+            self.update_profile_list()
+            dialog.accept()
+        btn.clicked.connect(save)
+        layout.addWidget(btn)
+        dialog.exec()
+
+    def delete_profile(self):
+        item = self.profile_list.currentItem()
+        if not item: return
+        url = item.text(2)
+        if self.client.logged_in:
+            try:
+                self.client.remove_favorite(url)
+                self.refresh()
+            except Exception as e: QMessageBox.critical(self, "Error", str(e))
+        else:
+            self.client.delete_profile(url)
+            self.update_profile_list()
+
+    # --- Pagination & Download ---
+
+    def preview_chapters(self):
+        item = self.profile_list.currentItem()
+        if not item: return
+        
+        url = item.text(2)
+        self.btn_dl_preview.setEnabled(False)
+        self.btn_dl_preview.setText("Loading...")
+
+        def done():
+            self.btn_dl_preview.setText("Preview & Download")
+            self.update_button_state()
+
+        # Initial Fetch: new posts from the API, everything older from the cache
+        def sync(url, job):
+            try: return self.client.sync_posts(url, job=job), None
+            except ApiError as e:
+                listing = self.client.cached_listing(url)
+                if not listing[0]: raise
+                return listing, e
+
+        def synced(result):
+            listing, error = result
+            if error: QMessageBox.warning(self, "Offline", f"Could not check for new chapters, showing cached ones.\n\n{error}")
+            self.open_preview(url, *listing)
+
+        self.start_job(sync, url, on_result=synced, on_finished=done)
+
+    def open_preview(self, url, records, offset=0):
+        self.current_preview_url = url
+        self.preview_jobs = []
+        last_fetched = self.client.profiles[url].get('last_fetched', '')
+        self.preview_model = ChapterListModel(records, offset + PAGE_SIZE, last_fetched, self.fetch_preview_page, self)
+
+        # UI Setup
+        self.preview_dialog = QDialog(self)
+        self.preview_dialog.setWindowTitle("Preview")
+        self.preview_dialog.resize(550, 600)
+        self.preview_dialog.finished.connect(self.cancel_preview_jobs)
+        layout = QVBoxLayout(self.preview_dialog)
+        
+        self.preview_view = QTreeView()
+        self.preview_view.setModel(self.preview_model)
+        self.preview_view.setRootIsDecorated(False)
+        self.preview_view.setUniformRowHeights(True) # Lets the view skip measuring every row
+        self.preview_view.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.preview_view.setColumnWidth(0, 350)
+        layout.addWidget(self.preview_view)
+
+        status = QLabel(self.preview_model.status())
+        layout.addWidget(status)
+
+        # More pages load as the list is scrolled; "Load All" pages through the rest at once
+        pag_layout = QHBoxLayout()
+        self.btn_retry = QPushButton("Retry")
+        self.btn_retry.clicked.connect(self.preview_model.retry)
+        self.btn_load_all = QPushButton("Load All")
+        self.btn_load_all.clicked.connect(self.load_all)
+        pag_layout.addWidget(self.btn_retry)
+        pag_layout.addWidget(self.btn_load_all)
+        layout.addLayout(pag_layout)
+
+        def state_changed():
+            model = self.preview_model
+            status.setText(model.status())
+            self.btn_retry.setVisible(bool(model.error))
+            self.btn_load_all.setEnabled(not (model.loading or model.exhausted))
+        self.preview_model.state_changed.connect(state_changed)
+        state_changed()
+        
+        btn_dl = QPushButton("Download Selected")
+        btn_dl.setStyleSheet("background-color: #28a745; color: white;")
+        btn_dl.clicked.connect(self.download_selected)
+        layout.addWidget(btn_dl)
+        
+        self.preview_dialog.exec()
+
+    def cancel_preview_jobs(self):
+        for job in self.preview_jobs: job.cancel()
+        self.preview_jobs = []
+
+    def fetch_preview_page(self, offset, on_loaded, on_failed):
+        def failed(error):
+            on_failed(error)
+            self.job_failed(error)
+        self.preview_jobs.append(self.start_job(self.client.fetch_page, self.current_preview_url, offset,
+                                                on_result=on_loaded, on_error=failed))
+
+    def load_all(self):
+        model = self.preview_model
+        model.set_loading(True)
+        self.btn_load_all.setText("Loading...")
+
+        # Pages arrive in offset order, so the list keeps the API's ordering
+        def page_loaded(page):
+            offset, data = page
+            model.page_loaded(offset, data)
+            self.btn_load_all.setText(f"Loading (Offset {offset})...")
+
+        def load(url, start, job):
+            for page in self.client.load_all(url, start, job=job): job.report(page)
+
+        def loaded(_):
+            model.exhausted = True
+            model.set_loading(False)
+            self.btn_load_all.setText("All Loaded")
+
+        # A failed page stops loading with an error instead of looking like the end of the list
+        def failed(error):
+            model.set_loading(False, error)
+            self.btn_load_all.setText("Load All")
+            self.job_failed(error)
+
+        job = self.start_job(load, self.current_preview_url, model.next_offset,
+                             on_progress=page_loaded, on_result=loaded, on_error=failed)
+        self.preview_jobs.append(job)
+
+    def download_selected(self):
+        rows = sorted(index.row() for index in self.preview_view.selectionModel().selectedRows())
+        if not rows:
+            QMessageBox.warning(self.preview_dialog, "Info", "No chapters selected.")
+            return
+
+        records = [self.preview_model.records[row] for row in rows]
+        self.enqueue(self.current_preview_url, records)
+        self.preview_dialog.accept()
+
+    def download_date_range(self):
+        item = self.profile_list.currentItem()
+        if not item: return
+        url = item.text(2)
+        profile = self.client.profiles[url]
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Download Date Range")
+        layout = QVBoxLayout(dialog)
+        form = QFormLayout()
+        last = QDate.fromString(profile.get('last_fetched', '')[:10], Qt.DateFormat.ISODate)
+        from_in = QDateEdit(last.addDays(1) if last.isValid() else QDate.currentDate().addMonths(-1))
+        to_in = QDateEdit(QDate.currentDate())
+        for edit in (from_in, to_in):
+            edit.setCalendarPopup(True)
+            edit.setDisplayFormat("yyyy-MM-dd")
+        form.addRow("From:", from_in)
+        form.addRow("To:", to_in)
+        layout.addLayout(form)
+        btn = QPushButton("Download")
+        layout.addWidget(btn)
+
+        def submit():
+            if to_in.date() < from_in.date():
+                QMessageBox.warning(dialog, "Info", "The range is empty.")
+                return
+            dialog.accept()
+            # A bare date sorts before every timestamp of that day, so both ends are inclusive
+            after = from_in.date().toString(Qt.DateFormat.ISODate)
+            before = to_in.date().toString(Qt.DateFormat.ISODate) + "T23:59:59.999999"
+            def found(records):
+                if not records:
+                    QMessageBox.information(self, "Info", "No chapters were published in that range.")
+                    return
+                self.enqueue(url, records[::-1])
+            self.start_job(self.client.fetch_range, url, after, before, on_result=found)
+
+        btn.clicked.connect(submit)
+        dialog.exec()
+
+    # --- Download Queue ---
+
+    def enqueue(self, url, records, priority=0):
+        """Queues a build of `records` and makes sure the queue is running."""
+        self.queue.add(url, records, priority=priority)
+        self.update_queue_list()
+        self.start_queue()
+
+    def start_queue(self, retry=False):
+        # A queue that is already running picks new entries up by itself
+        if self.queue_job: return
+        self.queue_failed = False
+        self.queue_job = self.start_job(self.queue.run, retry=retry, on_progress=self.queue_progress,
+                                        on_result=self.queue_done, on_error=self.queue_error,
+                                        on_finished=self.queue_finished)
+        self.btn_queue.setText("Stop")
+
+    def toggle_queue(self):
+        # Stopped builds stay queued and continue where they were on the next start
+        if self.queue_job: self.queue_job.cancel()
+        else: self.start_queue(retry=True)
+
+    def queue_progress(self, value):
+        entry_id, progress = value
+        if progress is None:
+            self.queue_status.pop(entry_id, None)
+            self.update_queue_list()
+            return
+        text, done, total = progress
+        self.queue_status[entry_id] = f"{text} {done}/{total}" if total else text
+        for i in range(self.queue_list.topLevelItemCount()):
+            item = self.queue_list.topLevelItem(i)
+            if item.text(4) == entry_id:
+                item.setText(3, self.queue_status[entry_id])
+                return
+        self.update_queue_list()
+
+    def queue_done(self, results):
+        built = [r for r in results.values() if not isinstance(r, Exception)]
+        failed = sum(isinstance(r, Exception) and not isinstance(r, Cancelled) for r in results.values())
+        if not (built or failed): return
+        paths = [path for paths, _ in built for path in paths]
+        msg = "EPUB saved:\n" + "\n".join(paths) if paths else "None of the chapters had any text." if built else ""
+        if (images := sum(len(failures) for _, failures in built)): msg += f"\n\n{images} image(s) failed to download."
+        if failed: msg += f"\n\n{failed} download(s) failed; they stay in the queue (right-click to retry)."
+        QMessageBox.information(self, "Downloads Finished", msg.strip())
+
+    def queue_error(self, error):
+        self.queue_failed = True
+        self.job_failed(error)
+
+    def queue_finished(self):
+        stopped = self.queue_job.cancelled
+        self.queue_job = None
+        self.queue_status.clear()
+        self.btn_queue.setText("Start")
+        self.update_queue_list()
+        # Entries added just as the run was ending are still waiting
+        if not (stopped or self.queue_failed) and any(not j.state.get('error') for j in self.queue.entries()):
+            self.start_queue()
+
+    def update_queue_list(self):
+        self.queue_list.clear()
+        for journal in self.queue.entries():
+            state = journal.state
+            status = self.queue_status.get(state['id']) or (f"Failed: {state['error']}" if state.get('error') else "Queued")
+            self.queue_list.addTopLevelItem(QTreeWidgetItem([
+                self.client.profiles[state['url']]['title'], str(len(state['records'])),
+                str(state.get('priority', 0)), status, state['id']]))
+
+    def show_queue_menu(self, pos):
+        item = self.queue_list.itemAt(pos)
+        if not item: return
+        entry_id, priority = item.text(4), int(item.text(2))
+        running = self.queue.is_running(entry_id)
+        menu = QMenu(self)
+        menu.addAction("Run Sooner", lambda: self.set_queue_priority(entry_id, priority + 1)).setEnabled(not running)
+        menu.addAction("Run Later", lambda: self.set_queue_priority(entry_id, priority - 1)).setEnabled(not running)
+        if item.text(3).startswith("Failed"): menu.addAction("Retry", lambda: self.retry_queue_entry(entry_id))
+        menu.addAction("Cancel", lambda: self.queue.cancel(entry_id)).setEnabled(running)
+        menu.addAction("Remove", lambda: self.remove_queue_entry(entry_id))
+        menu.exec(self.queue_list.mapToGlobal(pos))
+
+    def set_queue_priority(self, entry_id, priority):
+        self.queue.set_priority(entry_id, priority)
+        self.update_queue_list()
+
+    def retry_queue_entry(self, entry_id):
+        self.queue.retry(entry_id)
+        self.update_queue_list()
+        self.start_queue()
+
+    def remove_queue_entry(self, entry_id):
+        # A running build is stopped first; its row goes once it has
+        self.queue.remove(entry_id)
+        if not self.queue.is_running(entry_id): self.update_queue_list()
+
+    def offer_resume(self):
+        """Offers to continue downloads left in the queue (failed, stopped or the app closed)."""
+        pending = self.queue.entries()
+        if not pending or self.queue_job: return
+        lines = "\n".join(f"{self.client.profiles[j.state['url']]['title']}: {len(j.state['records'])} chapter(s)"
+                          for j in pending)
+        buttons = QMessageBox.StandardButton
+        answer = QMessageBox.question(self, "Resume Downloads",
+                                      f"{len(pending)} download(s) did not finish:\n\n{lines}\n\nResume them now?",
+                                      buttons.Yes | buttons.No | buttons.Discard)
+        if answer == buttons.Yes: self.start_queue(retry=True)
+        elif answer == buttons.Discard:
+            for journal in pending: journal.finish()
+            self.update_queue_list()
+
+    def open_defaults_window(self):
+        d = QDialog(self)
+        l = QVBoxLayout(d)
+        path = QLineEdit(self.client.default_directory)
+        btn = QPushButton("Browse")
+        btn.clicked.connect(lambda: path.setText(QFileDialog.getExistingDirectory(d, "Select Dir")))
+        h = QHBoxLayout()
+        h.addWidget(path)
+        h.addWidget(btn)
+        l.addLayout(h)
+        form = QFormLayout()
+        optimize = QCheckBox("Downscale and re-encode images (needs Pillow)")
+        optimize.setChecked(self.client.optimize_images)
+        max_size = QSpinBox()
+        max_size.setRange(256, 10000)
+        max_size.setSuffix(" px")
+        max_size.setValue(self.client.image_max_size)
+        quality = QSpinBox()
+        quality.setRange(10, 100)
+        quality.setValue(self.client.image_quality)
+        form.addRow("", optimize)
+        form.addRow("Longest side:", max_size)
+        form.addRow(f"{self.client.image_format.upper()} quality:", quality)
+        l.addLayout(form)
+        save = QPushButton("Save")
+        def save_defs():
+            self.client.default_directory = path.text()
+            self.client.optimize_images = optimize.isChecked()
+            self.client.image_max_size = max_size.value()
+            self.client.image_quality = quality.value()
+            self.client.save_defaults()
+            d.accept()
+        save.clicked.connect(save_defs)
+        l.addWidget(save)
+        d.exec()
+
+    def open_stats_window(self):
+        if not self.stats_window: self.stats_window = StatsWindow(self.client.metrics, self)
+        self.stats_window.show()
+        self.stats_window.raise_()
+
+def run_gui(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    app = QApplication(argv or sys.argv)
+    w = KemonoWebnovelDownloader()
+    w.show()
+    return app.exec()
@@ -0,0 +1,49 @@
+"""Optional image optimization for builds: downscale and re-encode with Pillow.
+
+optimize() runs in worker processes (decoding and encoding are CPU-bound);
+KemonoClient.recompress_images() drives it and caches the results in the
+image cache, keyed by source digest and settings_key().
+"""
+import io
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+IMAGE_MAX_SIZE = 1600       # Pixels on the longest side; e-reader screens don't show more
+IMAGE_QUALITY = 80
+IMAGE_FORMAT = 'jpeg'       # Or 'webp'
+OPTIMIZE_WORKERS = min(4, os.cpu_count() or 1) # Processes re-encoding images at once
+FORMATS = {'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+# Still images worth re-encoding; GIFs may be animated and are left alone
+OPTIMIZABLE_MEDIA = {'image/png', 'image/jpeg', 'image/webp', 'image/bmp'}
+
+def pillow_available():
+    try:
+        import PIL
+        return True
+    except ImportError:
+        return False
+
+def settings_key(max_size, fmt, quality):
+    return f"{fmt}-q{quality}-{max_size}px"
+
+def optimize(path, max_size=IMAGE_MAX_SIZE, fmt=IMAGE_FORMAT, quality=IMAGE_QUALITY):
+    """The image at `path` downscaled to fit max_size and re-encoded as `fmt`; None if that isn't smaller."""
+    from PIL import Image
+    with Image.open(path) as img:
+        if getattr(img, 'is_animated', False): return None
+        img.draft('RGB', (max_size, max_size)) # JPEGs decode at a reduced scale where possible
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS) # Only ever shrinks
+        alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+        if fmt == 'jpeg' and alpha:
+            # JPEG has no transparency: flatten onto white, like a page
+            rgba = img.convert('RGBA')
+            img = Image.new('RGB', img.size, 'white')
+            img.paste(rgba, mask=rgba.getchannel('A'))
+        elif img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if alpha else 'RGB')
+        out = io.BytesIO()
+        img.save(out, format=fmt.upper(), quality=quality, optimize=True)
+    data = out.getvalue()
+    return data if len(data) < os.path.getsize(path) else None
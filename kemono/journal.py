@@ -0,0 +1,65 @@
+"""Checkpoints of running builds, so an interrupted download can be resumed.
+
+Chapter bodies and images land in the post and image caches as soon as they
+are fetched, so a resumed build already skips everything that was
+downloaded. What a journal adds is the rest: which chapters were selected
+and where the book goes, how far the build got, and for volume builds the
+plan and which volumes are finished. Without the plan, a rerun would top up
+the last volume a second time.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+
+from .metrics import atomic_write
+
+log = logging.getLogger(__name__)
+
+JOURNAL_DIR = "journal"
+
+class DownloadJournal:
+    """One build's checkpoint, journal/<id>.json, rewritten atomically at every step.
+
+    `path` None keeps it in memory only, for callers that don't need to resume.
+    """
+    def __init__(self, path=None, state=None):
+        self.path = path
+        self.state = state or {}
+
+    @classmethod
+    def create(cls, url, records, output=None, priority=0, directory=JOURNAL_DIR):
+        os.makedirs(directory, exist_ok=True)
+        job_id = uuid.uuid4().hex[:12]
+        journal = cls(os.path.join(directory, f"{job_id}.json"), {
+            'id': job_id, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'url': url, 'output': output,
+            'records': [list(r[:3]) for r in records], 'stage': 'queued', 'plan': None, 'written': [],
+            'priority': priority, 'error': None,
+        })
+        journal.save()
+        return journal
+
+    @classmethod
+    def pending(cls, directory=JOURNAL_DIR):
+        """Journals of builds that never finished, oldest first; unreadable ones are skipped."""
+        if not os.path.isdir(directory): return []
+        journals = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.json'): continue
+            path = os.path.join(directory, name)
+            try:
+                with open(path) as f: journals.append(cls(path, json.load(f)))
+            except (OSError, ValueError) as e: log.warning(f"Skipping unreadable journal {path}: {e}")
+        return sorted(journals, key=lambda j: j.state.get('created', ''))
+
+    def update(self, **fields):
+        self.state.update(fields)
+        self.save()
+
+    def save(self):
+        if self.path: atomic_write(self.path, json.dumps(self.state))
+
+    def finish(self):
+        """The build is done (or abandoned): the journal goes away."""
+        if self.path and os.path.exists(self.path): os.remove(self.path)
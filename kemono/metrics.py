@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+class Metrics:
+    """Thread-safe counters and phase timers for the download hot paths.
+
+    Counters are plain running totals (requests, bytes, retries, cache
+    hits...). A phase records how often a block ran, the seconds spent in it
+    summed over every call (concurrent calls add up, so a phase can exceed
+    wall time) and its slowest call. snapshot() is what the GUI stats panel,
+    the CLI and the exporters read.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.phases = {}
+            self.started = time.time()
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name, seconds):
+        with self.lock:
+            phase = self.phases.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            phase['calls'] += 1
+            phase['seconds'] += seconds
+            phase['max_seconds'] = max(phase['max_seconds'], seconds)
+
+    def merge(self, snapshot):
+        """Adds another Metrics' snapshot(), e.g. one recorded in a worker process."""
+        with self.lock:
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in snapshot['phases'].items():
+                phase = self.phases.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                phase['calls'] += other['calls']
+                phase['seconds'] += other['seconds']
+                phase['max_seconds'] = max(phase['max_seconds'], other['max_seconds'])
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try: yield
+        finally: self.record(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'since': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'uptime_seconds': round(time.time() - self.started, 3),
+                'peak_rss_bytes': peak_rss_bytes(),
+                'counters': dict(sorted(self.counters.items())),
+                'phases': {name: {k: round(v, 4) if isinstance(v, float) else v for k, v in p.items()}
+                           for name, p in sorted(self.phases.items())},
+            }
+
+    # --- Export ---
+
+    def to_prometheus(self):
+        """Prometheus text exposition format, e.g. for node_exporter's textfile collector."""
+        snap = self.snapshot()
+        lines = []
+        def metric(name, kind, samples):
+            lines.append(f"# TYPE kemono_{name} {kind}")
+            lines.extend(f"kemono_{name}{labels} {value}" for labels, value in samples)
+        for name, value in snap['counters'].items():
+            metric(f"{prom_name(name)}_total", "counter", [("", value)])
+        for field in ('calls', 'seconds', 'max_seconds'):
+            kind = "gauge" if field == 'max_seconds' else "counter"
+            suffix = "" if field == 'max_seconds' else "_total"
+            metric(f"phase_{field}{suffix}", kind,
+                   [(f'{{phase="{name}"}}', p[field]) for name, p in snap['phases'].items()])
+        if snap['peak_rss_bytes'] is not None:
+            metric("peak_rss_bytes", "gauge", [("", snap['peak_rss_bytes'])])
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        atomic_write(path, json.dumps(self.snapshot(), indent=2))
+
+    def write_prometheus(self, path):
+        atomic_write(path, self.to_prometheus())
+
+def prom_name(name):
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+def atomic_write(path, text):
+    # Scrapers must never read a half-written file
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f: f.write(text)
+    os.replace(tmp, path)
+
+def peak_rss_bytes():
+    """Peak resident memory of this process, or None where it can't be read."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024 # kB everywhere else
+    except ImportError: pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+        class Counters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+        counters = Counters(cb=ctypes.sizeof(Counters))
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except (ImportError, AttributeError, OSError): pass
+    return None
@@ -0,0 +1,218 @@
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+
+from .metrics import Metrics
+
+log = logging.getLogger(__name__)
+
+REQUESTS_PER_SECOND = 3.0   # Courtesy ceiling for API requests, per host
+FILE_REQUESTS_PER_SECOND = 10.0 # Ceiling for image/file requests, per host
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0          # Seconds; doubles on every retry
+BACKOFF_MAX = 60.0
+RETRY_STATUSES = {429, 500, 502, 503, 504, 520, 521, 522, 523, 524}
+HTTP_POOL_SIZE = 16         # Keep-alive connections kept open per host
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
+# Kemono's API only answers scripted clients that ask for text/css (anything
+# else gets the DDoS-guard page), even though the body is JSON
+API_ACCEPT = "text/css"
+IMAGE_ACCEPT = "image/avif,image/webp,image/png,image/*;q=0.8,*/*;q=0.5"
+HTML_ACCEPT = "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8"
+# gzip/deflate always; br (and zstd) when urllib3 has the decoder installed
+ACCEPT_ENCODING = make_headers(accept_encoding=True)['accept-encoding']
+
+class SessionExpired(Exception):
+    pass
+
+class ApiError(Exception):
+    """A request failed in a way retrying won't fix (e.g. 400/403/404)."""
+
+class TransientError(ApiError):
+    """A request kept failing with 429/5xx/connection errors after every retry."""
+
+# --- Transport ---
+class Transport:
+    """The one HTTP client every request goes through.
+
+    A requests session with pools sized for the download workers, so
+    connections are kept alive and reused instead of re-handshaking per
+    image. Responses are negotiated compressed, and the Accept header is
+    picked per endpoint (see accept_for). With http2=True and httpx[http2]
+    installed, GETs are multiplexed over HTTP/2; both clients share one
+    cookie jar, so login state carries over.
+    """
+    def __init__(self, pool_size=HTTP_POOL_SIZE, http2=False):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'User-Agent': USER_AGENT, 'Accept-Encoding': ACCEPT_ENCODING})
+        self.errors = (requests.ConnectionError, requests.Timeout)
+        self.http2 = None
+        if http2:
+            try:
+                import httpx
+                limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+                self.http2 = httpx.Client(http2=True, limits=limits, follow_redirects=True,
+                                          headers=dict(self.session.headers), cookies=self.session.cookies)
+                self.errors += (httpx.TransportError,)
+            except ImportError:
+                log.warning("HTTP/2 needs 'pip install httpx[http2]'; using HTTP/1.1")
+
+    @property
+    def cookies(self):
+        return self.session.cookies
+
+    @staticmethod
+    def accept_for(url):
+        return API_ACCEPT if urlparse(url).path.startswith('/api/') else IMAGE_ACCEPT
+
+    def request(self, method, url, accept=None, **kwargs):
+        """Sends one request (no retries; see RequestScheduler). `accept` overrides accept_for(url)."""
+        headers = {'Accept': accept or self.accept_for(url), **kwargs.pop('headers', {})}
+        if self.http2 and method == 'GET':
+            return self.http2.get(url, headers=headers, **kwargs)
+        return self.session.request(method, url, headers=headers, **kwargs)
+
+    def close(self):
+        self.session.close()
+        if self.http2: self.http2.close()
+
+# --- Rate Limiting ---
+class RateLimiter:
+    """Adaptive token bucket shared between threads; acquire() blocks until a request may be sent.
+
+    The rate starts at `rate` and never exceeds it. slow_down() halves it (and
+    can pause the bucket entirely, e.g. for Retry-After); every success adds a
+    little back, so throughput settles just under what the server tolerates.
+    """
+    def __init__(self, rate, burst=None, min_rate=0.2):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, job=None):
+        # Builds queued side by side may all wait on one bucket, so waiting stays cancellable
+        while True:
+            if job: job.check()
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(min(wait, 0.5))
+
+    def slow_down(self, pause=0.0):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+# --- Scheduling ---
+def retry_after(response):
+    """Seconds requested by a Retry-After header (delta-seconds or HTTP date), or None."""
+    value = response.headers.get('Retry-After')
+    if not value: return None
+    try: return max(0.0, float(value))
+    except ValueError: pass
+    try: return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError): return None
+
+class RequestScheduler:
+    """Single gate for outgoing requests: per-host token buckets, retries and backoff.
+
+    API calls and file downloads on the same host get separate buckets, since
+    they have very different budgets. 429 and 5xx responses and connection
+    errors are retried with exponential backoff plus jitter, honouring
+    Retry-After; a 429 also slows the whole bucket down for every thread.
+    Once retries run out TransientError is raised, so callers can tell a
+    failure apart from an empty page. Requests, bytes, retries and time spent
+    are counted in `metrics`, split into api and file traffic.
+    """
+    def __init__(self, transport, api_rate=REQUESTS_PER_SECOND, file_rate=FILE_REQUESTS_PER_SECOND,
+                 max_retries=MAX_RETRIES, metrics=None):
+        self.transport = transport
+        self.metrics = metrics or Metrics()
+        self.api_rate = api_rate
+        self.file_rate = file_rate
+        self.max_retries = max_retries
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, url):
+        parsed = urlparse(url)
+        api = parsed.path.startswith('/api/')
+        key = (parsed.netloc, api)
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = RateLimiter(self.api_rate if api else self.file_rate)
+            return self.buckets[key], 'api' if api else 'file'
+
+    def backoff(self, attempt):
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def request(self, method, url, job=None, **kwargs):
+        """Sends a request; returns the response, or raises SessionExpired / ApiError / TransientError."""
+        bucket, kind = self.bucket(url)
+        metrics = self.metrics
+        kwargs.setdefault('timeout', 30)
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire(job)
+            metrics.add(f"http.{kind}.requests")
+            try:
+                with metrics.phase(f"http.{kind}"):
+                    response = self.transport.request(method, url, **kwargs)
+            except self.transport.errors as e:
+                problem, delay = str(e), self.backoff(attempt)
+            else:
+                status = response.status_code
+                if status == 401: raise SessionExpired()
+                if status not in RETRY_STATUSES:
+                    if status >= 400:
+                        metrics.add("http.errors")
+                        raise ApiError(f"HTTP {status} for {url}")
+                    metrics.add(f"http.{kind}.bytes", len(response.content))
+                    bucket.speed_up()
+                    return response
+                wait = retry_after(response)
+                problem, delay = f"HTTP {status}", max(wait or 0.0, self.backoff(attempt))
+                if status == 429:
+                    metrics.add("http.throttled")
+                    bucket.slow_down(pause=wait or 0.0)
+            if attempt == self.max_retries: break
+            metrics.add("http.retries")
+            log.info(f"{problem} for {url}; retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            self.sleep(delay, job)
+        metrics.add("http.errors")
+        raise TransientError(f"{problem} for {url} (gave up after {self.max_retries} retries)")
+
+    def sleep(self, seconds, job=None):
+        deadline = time.monotonic() + seconds
+        while (left := deadline - time.monotonic()) > 0:
+            if job: job.check()
+            time.sleep(min(left, 0.5))
@@ -0,0 +1,146 @@
+"""The downloader's own state: defaults, login, profiles, in one SQLite file.
+
+It replaces defaults.json, session.json, profiles.json / preferences.json
+and favorites.json, which are imported once (see StateStore.migrate) and
+then renamed to *.migrated. WAL mode plus a busy timeout lets the GUI and a
+scheduled command line run write at the same time, and every change is a
+small transaction of its own rather than a rewrite of a whole file.
+"""
+import os
+import json
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+STATE_FILE = "state.db"
+SCHEMA_VERSION = 1
+BUSY_TIMEOUT_MS = 10000     # How long a writer waits for another process's transaction
+PROFILE_SCOPES = {'profiles.json': 'local', 'preferences.json': 'account'}
+
+class StateStore:
+    """Settings (section, key) -> JSON value, and profiles per scope.
+
+    Profiles of the local list and of the logged-in account's favorites are
+    kept apart, as 'local' and 'account'. A profile's last_fetched has a
+    column of its own and only ever moves forward, so two processes that
+    both finish a download can't set it back. Like PostCache, one
+    connection is shared between threads behind a lock.
+    """
+    def __init__(self, path=STATE_FILE, legacy_dir=None):
+        self.lock = threading.Lock()
+        # Autocommit; transaction() opens each write transaction explicitly
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.transaction():
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS settings (
+                section TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (section, key))""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS profiles (
+                scope TEXT NOT NULL, url TEXT NOT NULL, data TEXT NOT NULL, last_fetched TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (scope, url))""")
+        self.migrate(os.path.dirname(os.path.abspath(path)) if legacy_dir is None else legacy_dir)
+
+    @contextmanager
+    def transaction(self):
+        # IMMEDIATE takes the write lock up front, so concurrent writers queue instead of failing halfway
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try: yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    # --- Settings ---
+
+    def get(self, section, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM settings WHERE section=? AND key=?", (section, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def section(self, section):
+        with self.lock:
+            rows = self.conn.execute("SELECT key, value FROM settings WHERE section=?", (section,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def put(self, section, values):
+        with self.transaction():
+            self.conn.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?, ?)",
+                                  [(section, key, json.dumps(value)) for key, value in values.items()])
+
+    def delete(self, section, *keys):
+        """Removes `keys` from a section, or the whole section without any."""
+        with self.transaction():
+            if not keys: self.conn.execute("DELETE FROM settings WHERE section=?", (section,))
+            for key in keys: self.conn.execute("DELETE FROM settings WHERE section=? AND key=?", (section, key))
+
+    # --- Profiles ---
+
+    def profiles(self, scope):
+        """{url: profile} of a scope, in the order they were added."""
+        with self.lock:
+            rows = self.conn.execute("SELECT url, data, last_fetched FROM profiles WHERE scope=? ORDER BY rowid",
+                                     (scope,)).fetchall()
+        return {url: {**json.loads(data), 'last_fetched': last_fetched} for url, data, last_fetched in rows}
+
+    def save_profile(self, scope, url, fields):
+        """Writes these fields of a profile, leaving its other fields as they are; a None value removes one."""
+        fields = dict(fields)
+        last_fetched = fields.pop('last_fetched', None) or ''
+        with self.transaction():
+            self.conn.execute("""INSERT INTO profiles (scope, url, data, last_fetched)
+                VALUES (?, ?, json_patch('{}', ?), ?) ON CONFLICT (scope, url) DO UPDATE SET
+                data = json_patch(data, excluded.data), last_fetched = MAX(last_fetched, excluded.last_fetched)""",
+                (scope, url, json.dumps(fields), last_fetched))
+
+    def delete_profile(self, scope, url):
+        with self.transaction():
+            self.conn.execute("DELETE FROM profiles WHERE scope=? AND url=?", (scope, url))
+
+    # --- Migration ---
+
+    def migrate(self, directory):
+        """Imports the JSON state files of older versions, once.
+
+        Each file that was imported is renamed, so it isn't imported again.
+        While any is unreadable (say, half written) the migration isn't
+        marked done and is tried again at the next start, rather than that
+        file's profiles being lost for good.
+        """
+        with self.lock:
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION: return
+        imported = {}
+        failed = []
+        for name in ('defaults.json', 'session.json', 'favorites.json', *PROFILE_SCOPES):
+            path = os.path.join(directory, name)
+            if not os.path.exists(path): continue
+            try:
+                with open(path) as f: imported[name] = json.load(f)
+            except (OSError, ValueError) as e:
+                log.warning(f"Can't import {path} ({e}); it is tried again at the next start, once repaired")
+                failed.append(name)
+
+        with self.transaction():
+            # Another process may have got here first
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION: return
+            settings = [('defaults', key, value) for key, value in (imported.get('defaults.json') or {}).items()]
+            if 'session.json' in imported: settings.append(('account', 'session', imported['session.json']))
+            if 'favorites.json' in imported: settings.append(('account', 'favorites', imported['favorites.json']))
+            self.conn.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?, ?)",
+                                  [(section, key, json.dumps(value)) for section, key, value in settings])
+            for name, scope in PROFILE_SCOPES.items():
+                for url, profile in (imported.get(name) or {}).items():
+                    if not isinstance(profile, dict): continue
+                    data = {k: v for k, v in profile.items() if k != 'last_fetched'}
+                    self.conn.execute("INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?)",
+                                      (scope, url, json.dumps(data), profile.get('last_fetched') or ''))
+            if not failed: self.conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        for name in imported:
+            path = os.path.join(directory, name)
+            try: os.replace(path, path + '.migrated')
+            except OSError as e: log.warning(f"Could not rename {path} after importing it: {e}")
+        if imported: log.info(f"Imported {', '.join(imported)} into the state store")